@@ -0,0 +1,76 @@
+"""Minimal binding of opendir(3)/readdir(3) on Linux, through ctypes, for
+the types of the directory entries that os.listdir() throws away."""
+import os
+import sys
+
+try:
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+except (ImportError, OSError):
+    libc = None
+
+
+# From dirent.h
+DT_UNKNOWN = 0
+DT_DIR = 4
+DT_REG = 8
+DT_LNK = 10
+
+
+if libc is not None:
+    class Dirent64(ctypes.Structure):
+        # The layout of struct dirent64 on Linux, the same in every architecture
+        _fields_ = [
+            ('d_ino', ctypes.c_uint64),
+            ('d_off', ctypes.c_int64),
+            ('d_reclen', ctypes.c_ushort),
+            ('d_type', ctypes.c_ubyte),
+            ('d_name', ctypes.c_char * 256),
+        ]
+    
+    try:
+        _opendir = libc.opendir
+        _readdir = libc.readdir64
+        _closedir = libc.closedir
+    except AttributeError:
+        _opendir = _readdir = _closedir = None
+    else:
+        _opendir.argtypes = [ctypes.c_char_p]
+        _opendir.restype = ctypes.c_void_p
+        _readdir.argtypes = [ctypes.c_void_p]
+        _readdir.restype = ctypes.POINTER(Dirent64)
+        _closedir.argtypes = [ctypes.c_void_p]
+        _closedir.restype = ctypes.c_int
+else:
+    _opendir = _readdir = _closedir = None
+
+
+def is_available():
+    return sys.platform.startswith('linux') and _opendir is not None
+
+
+def list_dir(path):
+    """Returns a list with the (name, type) pair of each entry in the
+    directory, without '.' and '..'. The type is one of the DT_* constants,
+    DT_UNKNOWN where the file system does not tell it."""
+    dir = _opendir(path)
+    if not dir:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), path)
+    
+    entries = []
+    try:
+        while True:
+            # readdir() returns NULL both at the end and on errors
+            ctypes.set_errno(0)
+            entry = _readdir(dir)
+            if not entry:
+                e = ctypes.get_errno()
+                if e:
+                    raise OSError(e, os.strerror(e), path)
+                return entries
+            name = entry.contents.d_name
+            if name != '.' and name != '..':
+                entries.append((name, entry.contents.d_type))
+    finally:
+        _closedir(dir)
@@ -0,0 +1,284 @@
+"""Copies file contents with the fastest mechanism available.
+
+In order of preference: a reflink clone (FICLONE ioctl), copy_file_range(2),
+sendfile(2) and finally a plain read/write loop. A mechanism that is not
+supported between two devices is not tried again for them.
+
+Unless cloned, the destination file is first preallocated with fallocate(2),
+so that a full device is found before any data is written.
+
+In streaming mode (see enable_streaming()), the page cache used by the
+copies is kept bounded: the source is read ahead sequentially and its pages
+are dropped once copied, and the destination is written back every
+SYNC_SIZE bytes, and at the end of each file, and its pages dropped.
+"""
+import errno
+import os
+import shutil
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+except (ImportError, OSError):
+    libc = None
+
+
+FICLONE = 0x40049409
+
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+POSIX_FADV_NOREUSE = 5
+
+FALLOC_FL_KEEP_SIZE = 1
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Bytes written to a destination file between write-backs in streaming mode
+SYNC_SIZE = 32 * 1024 * 1024
+
+# errno values meaning "this mechanism does not work here"
+UNSUPPORTED_ERRNOS = frozenset([
+    errno.ENOSYS,
+    errno.EXDEV,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+])
+
+
+def _libc_function(name, argtypes):
+    try:
+        function = getattr(libc, name)
+    except AttributeError:
+        return None
+    function.argtypes = argtypes
+    function.restype = ctypes.c_ssize_t
+    return function
+
+if libc is not None:
+    _copy_file_range = _libc_function('copy_file_range', [
+        ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint])
+    _sendfile = _libc_function('sendfile', [
+        ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+    # The plain names take a 32-bit off_t on 32-bit systems. The 64 variants
+    # take a 64-bit one everywhere.
+    _posix_fadvise = (_libc_function('posix_fadvise64', [
+                          ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int]) or
+                      _libc_function('posix_fadvise', [
+                          ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int]))
+    if _posix_fadvise is not None:
+        # Returns an error number instead of setting errno
+        _posix_fadvise.restype = ctypes.c_int
+    _fallocate = (_libc_function('fallocate64', [
+                      ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]) or
+                  _libc_function('fallocate', [
+                      ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]))
+else:
+    _copy_file_range = _sendfile = _posix_fadvise = _fallocate = None
+
+
+def advise(fd, offset, length, advice):
+    """posix_fadvise(2). A length of 0 means up to the end of the file.
+    Returns False if it is not possible."""
+    if _posix_fadvise is None:
+        return False
+    return _posix_fadvise(fd, offset, length, advice) == 0
+
+
+def drop_cache(fd):
+    """Asks the kernel to drop the cached pages of a file, so that it is read
+    from the device again. Pages not yet written are not dropped, so the file
+    should be synced first. Returns False if it is not possible."""
+    return advise(fd, 0, 0, POSIX_FADV_DONTNEED)
+
+
+fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+streaming = False
+
+def enable_streaming():
+    global streaming
+    streaming = True
+
+
+class Stream(object):
+    """Page cache handling of a copy in streaming mode. advance() is called
+    as the copy goes on, with the file offsets at the point copied up to,
+    and finish() at the end."""
+    
+    def __init__(self, src_fd, dst_fd):
+        self.src_fd = src_fd
+        self.dst_fd = dst_fd
+        self.src_dropped = 0
+        self.dst_synced = 0
+        advise(src_fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+        advise(src_fd, 0, 0, POSIX_FADV_NOREUSE)
+    
+    def advance(self):
+        src_position = os.lseek(self.src_fd, 0, os.SEEK_CUR)
+        if src_position > self.src_dropped:
+            advise(self.src_fd, self.src_dropped, src_position - self.src_dropped, POSIX_FADV_DONTNEED)
+            self.src_dropped = src_position
+        
+        dst_position = os.lseek(self.dst_fd, 0, os.SEEK_CUR)
+        if dst_position - self.dst_synced >= SYNC_SIZE:
+            self.sync(dst_position)
+    
+    def sync(self, dst_position):
+        # Written pages can only be dropped once they are clean
+        fdatasync(self.dst_fd)
+        advise(self.dst_fd, self.dst_synced, dst_position - self.dst_synced, POSIX_FADV_DONTNEED)
+        self.dst_synced = dst_position
+    
+    def finish(self):
+        self.advance()
+        dst_position = os.lseek(self.dst_fd, 0, os.SEEK_CUR)
+        if dst_position > self.dst_synced:
+            self.sync(dst_position)
+
+
+_unsupported = set()
+_unsupported_lock = threading.Lock()
+
+def _is_supported(method, devices):
+    return (method, devices) not in _unsupported
+
+def _set_unsupported(method, devices):
+    with _unsupported_lock:
+        _unsupported.add((method, devices))
+
+
+def preallocate(fd, size):
+    """Reserves size bytes in the device for the file, without changing its
+    size. Raises OSError with ENOSPC if they do not fit. Returns False if the
+    file system does not support it.
+    
+    fallocate() is used instead of posix_fallocate(), which the C library
+    emulates by writing to every block where the file system lacks support.
+    """
+    if _fallocate is None or size == 0:
+        return False
+    devices = (os.fstat(fd).st_dev,)
+    if not _is_supported('fallocate', devices):
+        return False
+    
+    while _fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size) < 0:
+        e = ctypes.get_errno()
+        if e == errno.EINTR:
+            continue
+        if e in UNSUPPORTED_ERRNOS:
+            _set_unsupported('fallocate', devices)
+            return False
+        raise OSError(e, os.strerror(e))
+    return True
+
+
+def _clone(src_fd, dst_fd):
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, 'FICLONE not available')
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+
+def _kernel_copy(function, call, src_fd, dst_fd, stream=None, progress=None):
+    """Copies with copy_file_range() or sendfile() from the current offsets,
+    until the end of the source file."""
+    if function is None:
+        raise OSError(errno.ENOSYS, 'Function not available in libc')
+    
+    while True:
+        result = call(src_fd, dst_fd)
+        if result < 0:
+            e = ctypes.get_errno()
+            if e == errno.EINTR:
+                continue
+            raise OSError(e, os.strerror(e))
+        if result == 0:
+            return
+        if stream is not None:
+            stream.advance()
+        if progress is not None:
+            progress(result)
+
+
+def _copy_file_range_call(src_fd, dst_fd):
+    return _copy_file_range(src_fd, None, dst_fd, None, CHUNK_SIZE, 0)
+
+def _sendfile_call(src_fd, dst_fd):
+    return _sendfile(dst_fd, src_fd, None, CHUNK_SIZE)
+
+
+def copy_file(src, dst, sync=False, progress=None):
+    """Copies the contents of the file src to dst (like shutil.copyfile()).
+    If sync, the copy is written to the device before returning. If given,
+    progress is called with the number of bytes of each chunk copied."""
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            _copy_contents(fsrc, fdst, progress)
+            if sync:
+                fdst.flush()
+                fdatasync(fdst.fileno())
+
+
+def _copy_contents(fsrc, fdst, progress=None):
+    src_fd = fsrc.fileno()
+    dst_fd = fdst.fileno()
+    devices = (os.fstat(src_fd).st_dev, os.fstat(dst_fd).st_dev)
+    
+    if _is_supported('clone', devices):
+        try:
+            _clone(src_fd, dst_fd)
+            if progress is not None:
+                progress(os.fstat(src_fd).st_size)
+            return
+        except (IOError, OSError) as e:
+            if e.errno not in UNSUPPORTED_ERRNOS:
+                raise
+            _set_unsupported('clone', devices)
+    
+    preallocate(dst_fd, os.fstat(src_fd).st_size)
+    stream = Stream(src_fd, dst_fd) if streaming else None
+    
+    for (method, function, call) in (('copy_file_range', _copy_file_range, _copy_file_range_call),
+                                     ('sendfile', _sendfile, _sendfile_call)):
+        if _is_supported(method, devices):
+            try:
+                _kernel_copy(function, call, src_fd, dst_fd, stream, progress)
+                if stream is not None:
+                    stream.finish()
+                return
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                _set_unsupported(method, devices)
+    
+    # A kernel copy that failed midway advanced both file offsets, so the
+    # copy continues from there.
+    fsrc.seek(os.lseek(src_fd, 0, os.SEEK_CUR))
+    fdst.seek(os.lseek(dst_fd, 0, os.SEEK_CUR))
+    if stream is None and progress is None:
+        shutil.copyfileobj(fsrc, fdst, CHUNK_SIZE)
+    else:
+        _loop_copy(fsrc, fdst, stream, progress)
+
+
+def _loop_copy(fsrc, fdst, stream=None, progress=None):
+    """Copies with a read/write loop in streaming mode or reporting the
+    progress."""
+    while True:
+        data = fsrc.read(CHUNK_SIZE)
+        if not data:
+            break
+        fdst.write(data)
+        if stream is not None:
+            fdst.flush()
+            stream.advance()
+        if progress is not None:
+            progress(len(data))
+    if stream is not None:
+        stream.finish()
@@ -1,18 +1,39 @@
+import errno
+import os
 import os.path
 import shutil
+import sys
+import threading
+import time
 from collections import namedtuple
+from Queue import Queue
 
+import rms.fastcopy
 import rms.scanner as scanner
+import rms.verify
 
 
 def delete(base_path, item_relpath):
+    remove(base_path, item_relpath)
+    prune_empty_dirs(base_path, item_relpath)
+
+
+def remove(base_path, item_relpath):
+    """Deletes an item without pruning its parent directories."""
     full_path = os.path.join(base_path, item_relpath)
-    if os.path.isdir(full_path):
-        shutil.rmtree(full_path)
-    else:
+    try:
+        # Most items are files, which are then deleted without a stat() call
         os.remove(full_path)
-    
-    # Delete  empty directories
+    except OSError as e:
+        # Removing a directory fails with EISDIR on Linux and EPERM elsewhere
+        if e.errno in (errno.EISDIR, errno.EPERM) and os.path.isdir(full_path):
+            shutil.rmtree(full_path)
+        else:
+            raise
+
+
+def prune_empty_dirs(base_path, item_relpath):
+    """Deletes the parent directories of a removed item that became empty."""
     while '/' in item_relpath:
         (item_relpath, _) = os.path.split(item_relpath)
         full_path = os.path.join(base_path, item_relpath)
@@ -24,19 +45,281 @@ def delete(base_path, item_relpath):
             break
 
 
-def copy(src_dir, dst_dir, item_path):
+class DeletionBatch(object):
+    """Deletes items, leaving the parent directories that become empty to be
+    pruned all at once by prune().
+    
+    Each parent directory is then listed at most once, instead of once for
+    every deleted item under it.
+    """
+    
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.parents = set()
+    
+    def delete(self, item_relpath):
+        remove(self.base_path, item_relpath)
+        parent = os.path.dirname(item_relpath)
+        if parent:
+            self.parents.add(parent)
+    
+    def prune(self):
+        """Deletes the parent directories of the deleted items that became
+        empty, deepest first."""
+        dirs = set()
+        for dir_relpath in self.parents:
+            while dir_relpath and dir_relpath not in dirs:
+                dirs.add(dir_relpath)
+                dir_relpath = os.path.dirname(dir_relpath)
+        self.parents.clear()
+        
+        # Directories known to still have something in them
+        not_empty = set()
+        for dir_relpath in sorted(dirs, key=lambda dir_relpath: dir_relpath.count('/'), reverse=True):
+            parent = os.path.dirname(dir_relpath)
+            if dir_relpath not in not_empty:
+                full_path = os.path.join(self.base_path, dir_relpath)
+                if os.path.isdir(full_path) and len(os.listdir(full_path)) == 0:
+                    os.rmdir(full_path)
+                    continue
+            not_empty.add(parent)
+
+
+def rename(base_path, old_relpath, new_relpath):
+    old = os.path.join(base_path, old_relpath)
+    new = os.path.join(base_path, new_relpath)
+    
+    dir, _ = os.path.split(new)
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+    os.rename(old, new)
+    
+    prune_empty_dirs(base_path, old_relpath)
+
+
+def copy_file_function(dst_dir, manifest=None, sync=False, progress=None):
+    """Returns the function that copies files into dst_dir. If a manifest is
+    given, the copied files are verified and added to it. Verified copies,
+    and all copies if sync is set, are written to the device before the
+    function returns. If given, progress is called with the number of bytes
+    of each chunk copied."""
+    if manifest is None:
+        if sync or progress is not None:
+            return lambda src_file, dst_file: rms.fastcopy.copy_file(src_file, dst_file, sync, progress)
+        return rms.fastcopy.copy_file
+    
+    def copy_file(src_file, dst_file):
+        (digest, size) = rms.verify.copy_verified(src_file, dst_file, progress)
+        manifest.add(os.path.relpath(dst_file, dst_dir), size, digest)
+    return copy_file
+
+
+def copy(src_dir, dst_dir, item_path, manifest=None, sync=False, progress=None):
+    """Copies an item. If a manifest is given, the copied files are verified
+    and added to it. If sync is set, they are written to the device before
+    returning, so that the copy can be journaled. If given, progress is
+    called with the number of bytes of each chunk copied."""
     src = os.path.join(src_dir, item_path)
     dst = os.path.join(dst_dir, item_path)
+    copy_file = copy_file_function(dst_dir, manifest, sync, progress)
     
     if os.path.isdir(src):
         if os.path.isdir(dst):
             os.rmdir(dst)
-        shutil.copytree(src, dst, ignore=ignore_non_media)
+        copytree(src, dst, ignore=ignore_non_media, copy_file=copy_file)
+    else:
+        dir, _ = os.path.split(dst)
+        if not os.path.isdir(dir):
+            try:
+                os.makedirs(dir)
+            except OSError as e:
+                # Another thread may have just created it
+                if e.errno != errno.EEXIST:
+                    raise
+        copy_file(src, dst)
+        shutil.copymode(src, dst)
+
+
+def copytree(src, dst, ignore=None, copy_file=rms.fastcopy.copy_file):
+    """Like shutil.copytree(), but with file contents copied by copy_file(),
+    rms.fastcopy.copy_file() by default."""
+    names = os.listdir(src)
+    if ignore is not None:
+        ignored_names = ignore(src, names)
     else:
+        ignored_names = set()
+    
+    os.makedirs(dst)
+    for name in names:
+        if name in ignored_names:
+            continue
+        src_name = os.path.join(src, name)
+        dst_name = os.path.join(dst, name)
+        if os.path.isdir(src_name):
+            copytree(src_name, dst_name, ignore, copy_file)
+        else:
+            copy_file(src_name, dst_name)
+            shutil.copystat(src_name, dst_name)
+    shutil.copystat(src, dst)
+
+
+# Modification times closer than this are considered equal, as FAT file
+# systems store them with a resolution of 2 seconds.
+MTIME_TOLERANCE = 2
+
+# copy, delete: relpaths of album files, relative to the album
+AlbumDelta = namedtuple('AlbumDelta', 'copy,delete,copy_size')
+
+
+def album_files(album_fullpath):
+    """Returns a dict mapping the relpath of each media file in the album to
+    its (size, mtime)."""
+    files = {}
+    for (dir_fullpath, dirs, filenames) in os.walk(album_fullpath):
+        for filename in filenames:
+            if scanner.is_album_media_file(filename):
+                file_fullpath = os.path.join(dir_fullpath, filename)
+                stat = os.stat(file_fullpath)
+                files[os.path.relpath(file_fullpath, album_fullpath)] = (stat.st_size, stat.st_mtime)
+    return files
+
+
+def album_delta(src_dir, dst_dir, album_relpath):
+    """Compares the files of an album in the source and in the destination
+    by size and modification time. Returns the files that are missing or
+    changed in the destination and the ones no longer in the source."""
+    src_files = album_files(os.path.join(src_dir, album_relpath))
+    dst_files = album_files(os.path.join(dst_dir, album_relpath))
+    
+    copy = []
+    copy_size = 0
+    for (file_relpath, (size, mtime)) in sorted(src_files.iteritems()):
+        dst_file = dst_files.get(file_relpath)
+        if dst_file is None or dst_file[0] != size or abs(dst_file[1] - mtime) >= MTIME_TOLERANCE:
+            copy.append(file_relpath)
+            copy_size += size
+    
+    delete = sorted(file_relpath for file_relpath in dst_files if file_relpath not in src_files)
+    
+    return AlbumDelta(copy=copy, delete=delete, copy_size=copy_size)
+
+
+def apply_album_delta(src_dir, dst_dir, album_relpath, delta, manifest=None):
+    """Deletes and copies the files of the delta. If a manifest is given, the
+    copied files are verified and added to it, and the deleted ones removed
+    from it."""
+    src_album = os.path.join(src_dir, album_relpath)
+    dst_album = os.path.join(dst_dir, album_relpath)
+    copy_file = copy_file_function(dst_dir, manifest)
+    
+    for file_relpath in delta.delete:
+        delete(dst_album, file_relpath)
+    if manifest is not None:
+        manifest.forget(os.path.join(album_relpath, file_relpath) for file_relpath in delta.delete)
+    
+    for file_relpath in delta.copy:
+        src = os.path.join(src_album, file_relpath)
+        dst = os.path.join(dst_album, file_relpath)
         dir, _ = os.path.split(dst)
         if not os.path.isdir(dir):
             os.makedirs(dir)
-        shutil.copy(src, dst)
+        copy_file(src, dst)
+        # Keeps the modification time, which the next comparison relies on
+        shutil.copystat(src, dst)
+
+
+class CopyPool(object):
+    """Copies items on a pool of worker threads, limiting the total size of
+    the items being copied at the same time.
+    
+    An item larger than max_pending_size is only copied when nothing else is.
+    Errors raised by the workers are raised again by copy() or wait().
+    """
+    
+    def __init__(self, src_dir, dst_dir, jobs, max_pending_size, journal=None, manifest=None):
+        self.src_dir = src_dir
+        self.dst_dir = dst_dir
+        self.jobs = jobs
+        self.max_pending_size = max_pending_size
+        self.journal = journal
+        self.manifest = manifest
+        self.pending_size = 0
+        self.pending_count = 0
+        self.error = None
+        self.condition = threading.Condition()
+        self.queue = Queue()
+        
+        for _ in range(jobs if jobs > 1 else 0):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+    
+    def copy(self, item_relpath, size, progress=None):
+        """progress: the rms.progress.Progress to advance as the bytes of the
+        item are copied."""
+        if progress is not None:
+            progress = progress.item(size)
+        
+        if self.jobs <= 1:
+            self.copy_item(item_relpath, progress)
+            self.done(item_relpath, progress)
+            return
+        
+        with self.condition:
+            while (self.error is None and self.pending_count > 0
+                   and self.pending_size + size > self.max_pending_size):
+                self.condition.wait(1)
+            self.raise_error()
+            self.pending_size += size
+            self.pending_count += 1
+        self.queue.put((item_relpath, size, progress))
+    
+    def wait(self):
+        """Waits until all items have been copied."""
+        with self.condition:
+            while self.error is None and self.pending_count > 0:
+                self.condition.wait(1)
+            self.raise_error()
+    
+    def close(self):
+        for _ in range(self.jobs if self.jobs > 1 else 0):
+            self.queue.put(None)
+    
+    def copy_item(self, item_relpath, progress):
+        copy(self.src_dir, self.dst_dir, item_relpath, self.manifest, self.journal is not None,
+             progress.advance if progress is not None else None)
+    
+    def done(self, item_relpath, progress):
+        if self.journal is not None:
+            self.journal.copied(item_relpath)
+        if progress is not None:
+            progress.finish()
+    
+    def raise_error(self):
+        if self.error is not None:
+            (type, value, traceback) = self.error
+            raise type, value, traceback
+    
+    def work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            
+            (item_relpath, size, progress) = task
+            try:
+                if self.error is None:
+                    self.copy_item(item_relpath, progress)
+                    self.done(item_relpath, progress)
+            except:
+                with self.condition:
+                    if self.error is None:
+                        self.error = sys.exc_info()
+            finally:
+                with self.condition:
+                    self.pending_size -= size
+                    self.pending_count -= 1
+                    self.condition.notify_all()
 
 
 def ignore_non_media(dirpath, contents):
@@ -48,10 +331,48 @@ def ignore_non_media(dirpath, contents):
     return ignored
 
 
-DeviceData = namedtuple('DeviceData', 'total,free')
+# block_size: the allocation unit of the file system (the cluster size in
+# FAT file systems).
+DeviceData = namedtuple('DeviceData', 'total,free,block_size')
 
 def get_device_data(device_path):
     vfsstat = os.statvfs(device_path)
-    total = vfsstat.f_bsize * vfsstat.f_blocks
-    free = vfsstat.f_bsize * vfsstat.f_bavail
-    return DeviceData(total=total, free=free)
+    block_size = vfsstat.f_frsize or vfsstat.f_bsize
+    total = block_size * vfsstat.f_blocks
+    free = block_size * vfsstat.f_bavail
+    return DeviceData(total=total, free=free, block_size=block_size)
+
+
+
+class FreeSpace(object):
+    """Model of the free space in a device, updated from the sizes of the
+    deleted and copied items and reconciled with statvfs only now and then.
+    
+    Reconciling replaces the estimate with the measured free space, less the
+    size of the copies not finished yet, so that errors in the model do not
+    add up. Measuring while copies are running underestimates the free space,
+    as they are counted whole although partly written; the next measure
+    after they finish corrects it.
+    """
+    
+    RECONCILE_INTERVAL = 30
+    
+    def __init__(self, device_path, clock=time.time):
+        self.device_path = device_path
+        self.clock = clock
+        self.free = get_device_data(device_path).free
+        self.reconciled_time = clock()
+    
+    def deleted(self, size):
+        self.free += size
+    
+    def copied(self, size):
+        self.free -= size
+    
+    def reconcile(self, pending_size=0):
+        """pending_size: size of the copies not finished yet"""
+        self.free = get_device_data(self.device_path).free - pending_size
+        self.reconciled_time = self.clock()
+    
+    def reconcile_due(self):
+        return self.clock() - self.reconciled_time >= self.RECONCILE_INTERVAL
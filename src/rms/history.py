@@ -0,0 +1,83 @@
+"""Record of when each item was last in a destination, used to favor the
+items that have been away from it the longest when selecting media.
+"""
+import cPickle as pickle
+import math
+import os
+import os.path
+import random
+import time
+
+import rms.debug
+
+
+HISTORY_FILENAME = '.rmsync-history'
+
+FORMAT_VERSION = 1
+
+# Age given to the items that were never in the destination
+NEVER_PLACED_AGE = 365 * 24 * 60 * 60
+
+DAY = 24 * 60 * 60
+
+
+class History(object):
+    """Time when each item was last seen in the destination, kept in a file
+    in the destination directory."""
+    
+    def __init__(self, dst_dir):
+        self.filename = os.path.join(dst_dir, HISTORY_FILENAME)
+        self.placed_times = {}
+        self.load()
+    
+    def load(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                data = pickle.load(f)
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError) as e:
+            rms.debug.log("History not loaded:", str(e))
+            return
+        
+        if data.get('version') == FORMAT_VERSION:
+            self.placed_times = data['placed_times']
+    
+    def save(self):
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump({'version': FORMAT_VERSION, 'placed_times': self.placed_times}, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_filename, self.filename)
+    
+    def placed(self, item_relpaths, now=None):
+        """Records that the items are in the destination."""
+        if now is None:
+            now = time.time()
+        for relpath in item_relpaths:
+            self.placed_times[relpath] = now
+    
+    def weight(self, item_relpath, now=None):
+        """Returns 1 plus the number of days since the item was last in the
+        destination."""
+        if now is None:
+            now = time.time()
+        placed_time = self.placed_times.get(item_relpath)
+        if placed_time is None:
+            age = NEVER_PLACED_AGE
+        else:
+            age = max(now - placed_time, 0)
+        return 1 + float(age) / DAY
+
+
+def weighted_shuffle(items, weight, rng=random):
+    """Returns the items in a random order where each next item is chosen
+    among the remaining ones with a probability proportional to its weight.
+    
+    Instead of drawing the items one by one, which needs a structure to keep
+    the total of the remaining weights, each item gets the key u ** (1 / w)
+    for a uniform u, and the items are sorted by it (Efraimidis and
+    Spirakis). Its logarithm is used to keep it from rounding to 0.
+    """
+    keys = {}
+    for item in items:
+        # 1 - random() is never 0
+        keys[item] = math.log(1.0 - rng.random()) / weight(item)
+    return sorted(items, key=keys.__getitem__, reverse=True)
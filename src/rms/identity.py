@@ -0,0 +1,65 @@
+"""Content identity of media items, used to recognize the same item under
+different paths.
+
+The identity of a file is a hash of its size and of a few samples of its
+contents. The identity of an album also covers the relative path of each of
+its media files.
+"""
+import hashlib
+import os
+import os.path
+
+import rms.scanner
+
+
+SAMPLE_SIZE = 64 * 1024
+
+
+def hash_file_samples(h, file_fullpath):
+    size = os.path.getsize(file_fullpath)
+    h.update(str(size))
+    with open(file_fullpath, 'rb') as f:
+        if size <= 3 * SAMPLE_SIZE:
+            h.update(f.read())
+        else:
+            for offset in (0, (size - SAMPLE_SIZE) // 2, size - SAMPLE_SIZE):
+                f.seek(offset)
+                h.update(f.read(SAMPLE_SIZE))
+
+
+def item_identity(base_path, item):
+    """Returns the identity of a Media.Item found in base_path."""
+    h = hashlib.md5()
+    h.update(item.type)
+    
+    full_path = os.path.join(base_path, item.relpath)
+    if item.type == 'ALBUM':
+        files = []
+        for (dir_fullpath, dirs, filenames) in os.walk(full_path):
+            for filename in filenames:
+                if rms.scanner.is_album_media_file(filename):
+                    file_fullpath = os.path.join(dir_fullpath, filename)
+                    files.append(os.path.relpath(file_fullpath, full_path))
+        for file_relpath in sorted(files):
+            h.update('\0' + file_relpath + '\0')
+            hash_file_samples(h, os.path.join(full_path, file_relpath))
+    else:
+        hash_file_samples(h, full_path)
+    
+    return h.digest()
+
+
+class IdentityCache(object):
+    """Computes item identities on demand, at most once per item."""
+    
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.identities = {}
+    
+    def get(self, item):
+        try:
+            return self.identities[item.relpath]
+        except KeyError:
+            identity = item_identity(self.base_path, item)
+            self.identities[item.relpath] = identity
+            return identity
@@ -0,0 +1,78 @@
+import cPickle as pickle
+import os
+import os.path
+import threading
+
+import rms.debug
+
+
+FORMAT_VERSION = 1
+
+
+class ScanIndex(object):
+    """On-disk cache of directory listings, keyed by directory full path and
+    validated by the directory mtime.
+    """
+    
+    def __init__(self, filename, rescan=False):
+        self.filename = filename
+        self.entries = {}
+        self.visited = {}
+        self.roots = []
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        
+        if not rescan:
+            self.load()
+    
+    def load(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                data = pickle.load(f)
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError) as e:
+            rms.debug.log("Scan index not loaded:", str(e))
+            return
+        
+        if data.get('version') == FORMAT_VERSION:
+            self.entries = data['entries']
+    
+    def save(self):
+        entries = dict(
+            (path, entry) for path, entry in self.entries.iteritems()
+            if not any(is_under(path, root) for root in self.roots)
+        )
+        entries.update(self.visited)
+        
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump({'version': FORMAT_VERSION, 'entries': entries}, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_filename, self.filename)
+    
+    def add_root(self, media_dir):
+        with self.lock:
+            self.roots.append(os.path.abspath(media_dir))
+    
+    def get(self, dir_fullpath, mtime):
+        """Returns the cached listing of the directory, or None if it is not in
+        the index or has changed since it was indexed.
+        """
+        dir_fullpath = os.path.abspath(dir_fullpath)
+        with self.lock:
+            entry = self.entries.get(dir_fullpath)
+            if entry is not None and entry[0] == mtime:
+                self.hits += 1
+                self.visited[dir_fullpath] = entry
+                return entry[1]
+            else:
+                self.misses += 1
+                return None
+    
+    def put(self, dir_fullpath, mtime, listing):
+        dir_fullpath = os.path.abspath(dir_fullpath)
+        with self.lock:
+            self.visited[dir_fullpath] = (mtime, listing)
+
+
+def is_under(path, root):
+    return path == root or path.startswith(root.rstrip('/') + '/')
@@ -0,0 +1,86 @@
+"""Minimal binding of the Linux inotify API, through ctypes."""
+import errno
+import os
+import select
+import struct
+
+try:
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+except (ImportError, OSError):
+    libc = None
+
+
+# From sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+
+def is_available():
+    return libc is not None and hasattr(libc, 'inotify_init1')
+
+
+def _check(result):
+    if result < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return result
+
+
+class Inotify(object):
+    def __init__(self):
+        if not is_available():
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = _check(libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+    
+    def close(self):
+        os.close(self.fd)
+    
+    def add_watch(self, path, mask):
+        """Returns the watch descriptor."""
+        return _check(libc.inotify_add_watch(self.fd, path, mask))
+    
+    def rm_watch(self, wd):
+        _check(libc.inotify_rm_watch(self.fd, wd))
+    
+    def read(self, timeout=None):
+        """Waits up to timeout seconds for events and returns them as a list
+        of (wd, mask, cookie, name) tuples, which is empty if the time ran
+        out."""
+        (ready, _, _) = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        
+        events = []
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, length) = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
@@ -0,0 +1,127 @@
+import cPickle as pickle
+import os
+import os.path
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+
+JOURNAL_FILENAME = '.rmsync-journal'
+
+# delete, copy: lists of (type, relpath, size) tuples
+# block_size: the allocation unit the sizes were computed for, or None
+Plan = namedtuple('Plan', 'src_dir,delete,copy,device_free_target,mixed_mode,dst_media_size,block_size')
+
+# Changes whenever the contents of a plan file change
+PLAN_FILE_VERSION = 2
+
+# Seconds between syncs of the journal to the device. The items are synced
+# before they are recorded, so a lost record only makes an item be done
+# again.
+SYNC_INTERVAL = 10
+
+
+class Journal(object):
+    """Records a sync plan and each finished deletion and copy in a file in
+    the destination directory, so that an interrupted sync can be resumed.
+    
+    The file is a stream of pickled records, the first one being the plan.
+    A record truncated by a crash is ignored when loading.
+    """
+    
+    def __init__(self, dst_dir, plan, f):
+        self.filename = journal_filename(dst_dir)
+        self.plan = plan
+        self.deleted_paths = set()
+        self.copied_paths = set()
+        self.f = f
+        self.lock = threading.Lock()
+        self.sync_time = time.time()
+    
+    @classmethod
+    def create(cls, dst_dir, plan):
+        f = open(journal_filename(dst_dir), 'wb')
+        journal = cls(dst_dir, plan, f)
+        journal.write(('plan', tuple(plan)))
+        os.fsync(f.fileno())
+        return journal
+    
+    @classmethod
+    def load(cls, dst_dir):
+        """Returns the journal of an interrupted sync in dst_dir, or None."""
+        filename = journal_filename(dst_dir)
+        if not os.path.isfile(filename):
+            return None
+        
+        records = []
+        with open(filename, 'rb') as f:
+            while True:
+                try:
+                    records.append(pickle.load(f))
+                except (EOFError, ValueError, pickle.UnpicklingError):
+                    break
+        
+        if not records or records[0][0] != 'plan' or len(records[0][1]) != len(Plan._fields):
+            return None
+        
+        journal = cls(dst_dir, Plan(*records[0][1]), open(filename, 'ab'))
+        for (kind, path) in records[1:]:
+            if kind == 'deleted':
+                journal.deleted_paths.add(path)
+            elif kind == 'copied':
+                journal.copied_paths.add(path)
+        return journal
+    
+    def write(self, record):
+        with self.lock:
+            pickle.dump(record, self.f, pickle.HIGHEST_PROTOCOL)
+            self.f.flush()
+            now = time.time()
+            if now - self.sync_time >= SYNC_INTERVAL:
+                os.fsync(self.f.fileno())
+                self.sync_time = now
+    
+    def deleted(self, item_relpath):
+        self.deleted_paths.add(item_relpath)
+        self.write(('deleted', item_relpath))
+    
+    def copied(self, item_relpath):
+        self.copied_paths.add(item_relpath)
+        self.write(('copied', item_relpath))
+    
+    def close(self):
+        self.f.close()
+    
+    def finish(self):
+        """Closes and removes the journal after the plan has been completely
+        applied."""
+        self.close()
+        os.remove(self.filename)
+
+
+def journal_filename(dst_dir):
+    return os.path.join(dst_dir, JOURNAL_FILENAME)
+
+
+def write_plan(filename, plan):
+    """Writes the plan to a compressed file, to be applied by a later run."""
+    data = zlib.compress(pickle.dumps((PLAN_FILE_VERSION, tuple(plan)), pickle.HIGHEST_PROTOCOL))
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_filename, filename)
+
+
+def read_plan(filename):
+    """Returns the plan written to filename by write_plan(), or None if the
+    file cannot be read or was not written by this version."""
+    try:
+        with open(filename, 'rb') as f:
+            (version, fields) = pickle.loads(zlib.decompress(f.read()))
+    except (IOError, EOFError, ValueError, TypeError, zlib.error, pickle.UnpicklingError):
+        return None
+    
+    if version != PLAN_FILE_VERSION:
+        return None
+    return Plan(*fields)
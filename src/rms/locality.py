@@ -0,0 +1,87 @@
+"""Orders items by where their data is in the source device, so that copying
+them reads the disk mostly forward instead of seeking back and forth.
+
+"inode" orders by inode number, which most file systems allocate close to
+the data of the file and of its directory. "extent" orders by the physical
+offset of the first extent of the data (FIEMAP ioctl), falling back to the
+inode order for items whose extents cannot be known.
+"""
+import os
+import os.path
+import struct
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import rms.scanner
+
+
+ORDERS = ('path', 'inode', 'extent')
+
+# From linux/fs.h and linux/fiemap.h
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct('=QQLLLL')
+FIEMAP_EXTENT = struct.Struct('=QQQQQLLLL')
+FIEMAP_MAX_OFFSET = 0xFFFFFFFFFFFFFFFF
+
+
+def first_extent(file_fullpath):
+    """Returns the physical offset of the first extent of the file data, or
+    None if it is not known."""
+    if fcntl is None:
+        return None
+    
+    # Room for a single extent
+    request = FIEMAP_HEADER.pack(0, FIEMAP_MAX_OFFSET, 0, 0, 1, 0) + '\0' * FIEMAP_EXTENT.size
+    try:
+        fd = os.open(file_fullpath, os.O_RDONLY)
+        try:
+            result = fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+        finally:
+            os.close(fd)
+    except (IOError, OSError):
+        return None
+    
+    mapped_extents = FIEMAP_HEADER.unpack_from(result)[3]
+    if mapped_extents == 0:
+        return None
+    return FIEMAP_EXTENT.unpack_from(result, FIEMAP_HEADER.size)[1]
+
+
+def item_files(full_path):
+    """Returns the full paths of the files copied for an item."""
+    if not os.path.isdir(full_path):
+        return [full_path]
+    
+    files = []
+    for (dir_fullpath, dirs, filenames) in os.walk(full_path):
+        for filename in filenames:
+            if rms.scanner.is_album_media_file(filename):
+                files.append(os.path.join(dir_fullpath, filename))
+    return files
+
+
+def locality_key(base_path, item_relpath, order):
+    full_path = os.path.join(base_path, item_relpath)
+    if order == 'extent':
+        extents = [extent for extent in map(first_extent, item_files(full_path)) if extent is not None]
+        if extents:
+            return (0, min(extents))
+    
+    try:
+        stat = os.stat(full_path)
+    except OSError:
+        # Copying it will fail anyway
+        return (2,)
+    return (1, stat.st_dev, stat.st_ino)
+
+
+def sorted_paths(base_path, media, order):
+    """Returns the paths of the items in media in the given order."""
+    if order == 'path':
+        return media.sorted()
+    
+    keys = dict((path, locality_key(base_path, path, order)) for path in media)
+    return sorted(media, key=lambda path: (keys[path], path.upper()))
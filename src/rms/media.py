@@ -1,44 +1,164 @@
+from array import array
 from collections import namedtuple
+from itertools import compress, count
 
 
+TYPES = ('FILE', 'ALBUM')
+TYPE_CODES = dict((type, code) for (code, type) in enumerate(TYPES))
+
+# Where C longs have only 32 bits, doubles still hold sizes exactly up to 2**53
+if array('l').itemsize >= 8:
+    SIZES_TYPECODE = 'l'
+else:
+    SIZES_TYPECODE = 'd'
 
-class Media(dict):
-    Item = namedtuple('MediaItem', 'type,relpath,size')
 
+class MediaTable(object):
+    """Compact storage of media items: one row per path, with the type as a
+    small code and the size in an array.
     
-    def __init__(self, *args, **kwargs):
-        super(Media, self).__init__(*args, **kwargs)
-        self.size = sum(value.size for value in self.itervalues())
+    Media objects hold one membership flag per row of a table, so partitions
+    of the same scanned media share their items instead of copying them.
     
-    def __setitem__(self, key, value):
-        if key in self:
-            previous = self[key]
-            has_previous = True
-        else:
-            has_previous = False
-        
-        super(Media, self).__setitem__(key, value)
-        
-        if has_previous:
-            self.size -= previous.size
+    Rows are never changed nor removed, as the Media holding them keep their
+    sizes in their totals. A path added again with another type or size gets
+    a new row, which lookups by path find from then on. A Media that keeps
+    changing, like the one of a watched source, is compacted by copying its
+    items into a new table (see Media.compacted()).
+    """
+    
+    def __init__(self):
+        self.paths = []
+        self.types = array('B')
+        self.sizes = array(SIZES_TYPECODE)
+        self.indexes = {}
+    
+    def __len__(self):
+        return len(self.paths)
+    
+    def add(self, path, item):
+        """Returns the index of the row of path with the type and size of
+        item, which is created if the current row of path has others."""
+        type_code = TYPE_CODES[item.type]
+        index = self.indexes.get(path)
+        if index is None or self.types[index] != type_code or self.sizes[index] != item.size:
+            path = intern(path)
+            index = len(self.paths)
+            self.paths.append(path)
+            self.types.append(type_code)
+            self.sizes.append(item.size)
+            self.indexes[path] = index
+        return index
+    
+    def item(self, index):
+        return Media.Item(TYPES[self.types[index]], self.paths[index], int(self.sizes[index]))
+    
+    def size(self, index):
+        return int(self.sizes[index])
+
+
+class Media(object):
+    """Mapping from item relpath to Media.Item, keeping the total size of the
+    items in the size attribute."""
+    
+    Item = namedtuple('MediaItem', 'type,relpath,size')
+    
+    
+    def __init__(self, items=(), table=None):
+        """items: a mapping or an iterable of (relpath, Media.Item) pairs"""
+        if table is None:
+            table = MediaTable()
+        self.table = table
+        # One byte per table row, non-zero if the row is in self
+        self.flags = bytearray()
+        self.count = 0
+        self.size = 0
+        # Where popitem() starts looking for an item
+        self.pop_start = 0
         
-        self.size += value.size
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        for (key, value) in items:
+            self[key] = value
     
-    def __delitem__(self, key):
+    def sibling(self):
+        """Returns an empty Media sharing the table of self."""
+        return Media(table=self.table)
+    
+    def compacted(self):
+        """Returns a Media with the same items in a table of its own, without
+        the rows of the items no longer in self."""
+        return Media(self.iteritems())
+    
+    def copy(self):
+        """Returns a Media with the same items, sharing the table of self."""
+        media = self.sibling()
+        media.flags = bytearray(self.flags)
+        media.count = self.count
+        media.size = self.size
+        return media
+    
+    def has_index(self, index):
+        return index is not None and index < len(self.flags) and self.flags[index]
+    
+    def add_index(self, index):
+        if index >= len(self.flags):
+            self.grow()
+        self.flags[index] = 1
+        self.count += 1
+        self.size += self.table.size(index)
+    
+    def remove_index(self, index):
+        self.flags[index] = 0
+        self.count -= 1
+        self.size -= self.table.size(index)
+    
+    def grow(self):
+        """Adds the flags of the rows added to the table after self was created."""
+        self.flags.extend(bytearray(len(self.table) - len(self.flags)))
+    
+    def indexes(self):
+        return compress(count(), self.flags)
+    
+    def index(self, key):
+        index = self.table.indexes.get(key)
+        if index is None or index >= len(self.flags) or not self.flags[index]:
+            raise KeyError(key)
+        return index
+    
+    def __len__(self):
+        return self.count
+    
+    def __contains__(self, key):
+        return self.has_index(self.table.indexes.get(key))
+    
+    def __iter__(self):
+        paths = self.table.paths
+        return (paths[index] for index in self.indexes())
+    
+    def __getitem__(self, key):
+        return self.table.item(self.index(key))
+    
+    def get(self, key, default=None):
         if key in self:
-            previous = self[key]
-            has_previous = True
+            return self[key]
         else:
-            has_previous = False
-        
-        super(Media, self).__delitem__(key)
+            return default
+    
+    def __setitem__(self, key, value):
+        index = self.table.indexes.get(key)
+        if self.has_index(index):
+            self.remove_index(index)
         
-        if has_previous:
-            self.size -= previous.size
+        index = self.table.add(key, value)
+        self.add_index(index)
+    
+    def __delitem__(self, key):
+        self.remove_index(self.index(key))
     
     def pop(self, key, *args):
         try:
-            value = super(Media, self).pop(key)
+            index = self.index(key)
         except KeyError:
             if args:
                 (default,) = args
@@ -46,13 +166,19 @@ class Media(dict):
             else:
                 raise KeyError()
         else:
-            self.size -= value.size
-            return value
+            self.remove_index(index)
+            return self.table.item(index)
     
     def popitem(self):
-        (key, value) = super(Media, self).popitem()
-        self.size -= value.size
-        return (key, value)
+        if not self.count:
+            raise KeyError('popitem(): Media is empty')
+        index = self.flags.find('\x01', self.pop_start)
+        if index < 0:
+            index = self.flags.find('\x01')
+        self.pop_start = index + 1
+        self.remove_index(index)
+        item = self.table.item(index)
+        return (item.relpath, item)
     
     def setdefault(self, key, default=None):
         if key in self:
@@ -64,16 +190,52 @@ class Media(dict):
     def update(self, *args, **kwargs):
         raise NotImplementedError()
     
+    def keys(self):
+        return list(self)
+    
+    def iterkeys(self):
+        return iter(self)
+    
+    def values(self):
+        return list(self.itervalues())
+    
+    def itervalues(self):
+        table = self.table
+        return (table.item(index) for index in self.indexes())
+    
+    def items(self):
+        return list(self.iteritems())
+    
+    def iteritems(self):
+        table = self.table
+        return ((table.paths[index], table.item(index)) for index in self.indexes())
+    
     def sorted(self):
         return sorted(self, key=str.upper)
     
     def move(self, item_relpath, to):
-        item = self.pop(item_relpath)
-        to[item_relpath] = item
+        if to.table is self.table:
+            # Inlined remove_index() and add_index(), as this is called for
+            # every item when selecting media.
+            index = self.index(item_relpath)
+            size = self.table.size(index)
+            self.flags[index] = 0
+            self.count -= 1
+            self.size -= size
+            
+            if index >= len(to.flags):
+                to.grow()
+            if not to.flags[index]:
+                to.flags[index] = 1
+                to.count += 1
+                to.size += size
+        else:
+            item = self.pop(item_relpath)
+            to[item_relpath] = item
     
     def partition(self, to):
         """Move to a new Media every item in self that is not in to"""
-        difference = Media()
+        difference = self.sibling()
         for item in self.keys():
             if item not in to:
                 self.move(item, difference)
@@ -1,8 +1,11 @@
+import os.path
 import sys
 from optparse import OptionParser
 
 import rms.text
 import rms.debug
+import rms.inotify
+import rms.locality
 
 
 def get_options():
@@ -20,6 +23,28 @@ def get_options():
         rms.debug.log(dry_run=options.dry_run)
         rms.debug.log(mixed_mode=options.mixed_mode)
         rms.debug.log(delete_in_dst_only=options.delete_in_dst_only)
+        rms.debug.log(scan_index=options.scan_index)
+        rms.debug.log(rescan=options.rescan)
+        rms.debug.log(scan_jobs=options.scan_jobs)
+        rms.debug.log(seed=options.seed)
+        rms.debug.log(strategy=options.strategy)
+        rms.debug.log(copy_jobs=options.copy_jobs)
+        rms.debug.log(copy_buffer=options.copy_buffer)
+        rms.debug.log(resume=options.resume)
+        rms.debug.log(detect_renames=options.detect_renames)
+        rms.debug.log(profile=options.profile)
+        rms.debug.log(stats_json=options.stats_json)
+        rms.debug.log(write_plan=options.write_plan)
+        rms.debug.log(apply_plan=options.apply_plan)
+        rms.debug.log(refresh_albums=options.refresh_albums)
+        rms.debug.log(also_dest=options.also_dest)
+        rms.debug.log(copy_order=options.copy_order)
+        rms.debug.log(watch=options.watch)
+        rms.debug.log(history=options.history)
+        rms.debug.log(verify=options.verify)
+        rms.debug.log(check=options.check)
+        rms.debug.log(check_size=options.check_size)
+        rms.debug.log(copy_io=options.copy_io)
         rms.debug.log()
     
     if options.config_file is not None:
@@ -53,7 +78,10 @@ def parse_args():
                           that will be kept. Can be a percentage (see --free option
                           above) or an absolute number of items. Default: 0."""))
     parser.add_option("--ignore", metavar="ITEM-PATH", action="append", dest="ignore", default=[],
-                      help="Ignore an item.")
+                      help=clean("""Ignore an item. In this option and in the two below,
+                          each path component can be a glob pattern ("*", "?",
+                          "[...]"), and a last component "**" matches a directory
+                          and everything below it."""))
     parser.add_option("--is-album", metavar="DIR-PATH", action="append", dest="forced_albums", default=[],
                       help="Force a directory item to be treated as an album.")
     parser.add_option("--is-not-album", metavar="DIR-PATH", action="append", dest="not_albums", default=[],
@@ -68,6 +96,111 @@ def parse_args():
     parser.add_option("--delete-in-dst-only", action="store_true", default=False,
                       help=clean("""Delete media found in the destination which are not
                           in the source. ARE YOU SURE YOU WANT TO DO THIS?!"""))
+    parser.add_option("--scan-index", dest="scan_index", metavar="FILE", default=None,
+                      help=clean("""File where directory listings are cached between runs.
+                          Directories whose modification time did not change are
+                          not read again."""))
+    parser.add_option("--rescan", action="store_true", default=False,
+                      help=clean("""Ignore the contents of the scan index and read
+                          every directory again. The index is rewritten."""))
+    parser.add_option("-j", "--scan-jobs", dest="scan_jobs", metavar="JOBS", default=None,
+                      help=clean("""Number of threads used to compute album sizes.
+                          If greater than 1, the source and the destination are
+                          also scanned at the same time. Default: 1."""))
+    parser.add_option("--seed", dest="seed", metavar="SEED", default=None,
+                      help=clean("""Integer seed for the random selection of items.
+                          Runs with the same seed over the same media make the
+                          same selection. Each destination given with --also-dest
+                          gets its own random sequence derived from it."""))
+    parser.add_option("--strategy", dest="strategy", metavar="STRATEGY", default=None,
+                      help=clean("""How items are selected. "random": items are taken
+                          in random order while they fit in the destination. "fill":
+                          like "random", followed by a pass that swaps selected items
+                          with larger ones to fill the destination as much as
+                          possible. Default: random."""))
+    parser.add_option("--history", action="store_true", default=False,
+                      help=clean("""Keep a record of when each item was last in
+                          DESTINATION, in a file in it, and favor the items that
+                          have been away from it the longest when selecting
+                          media."""))
+    parser.add_option("--copy-jobs", dest="copy_jobs", metavar="JOBS", default=None,
+                      help=clean("""Number of items copied at the same time to the
+                          destination. Default: 1."""))
+    parser.add_option("--copy-buffer", dest="copy_buffer", metavar="SIZE", default=None,
+                      help=clean("""Maximum total size of the items being copied at the
+                          same time when --copy-jobs is greater than 1. A larger item
+                          is copied alone. Default: 512MiB."""))
+    parser.add_option("--copy-order", dest="copy_order", metavar="ORDER", default=None,
+                      help=clean("""Order in which items are copied. "path": by path.
+                          "inode": by inode number in SOURCE. "extent": by the
+                          position of their data in the SOURCE device, where the
+                          file system can tell it, or else by inode number. The
+                          last two reduce seeking on hard disks. Default: "path",
+                          or no particular order in mixed mode."""))
+    parser.add_option("--verify", action="store_true", default=False,
+                      help=clean("""Hash the files while copying them, read them back
+                          from DESTINATION to compare, and copy them again if they
+                          differ. The hashes are kept in a manifest in DESTINATION
+                          for --check."""))
+    parser.add_option("--check", action="store_true", default=False,
+                      help=clean("""Read back the files of DESTINATION verified by
+                          earlier syncs with --verify, the ones checked the longest
+                          ago first, and report the ones that no longer match,
+                          without syncing. SOURCE is not needed."""))
+    parser.add_option("--check-size", dest="check_size", metavar="SIZE", default=None,
+                      help=clean("""Maximum total size of the files read back by
+                          --check, so that a large DESTINATION is checked a part
+                          at a time. Default: all the files."""))
+    parser.add_option("--copy-io", dest="copy_io", metavar="MODE", default=None,
+                      help=clean("""How the copies use the page cache. "cached": as any
+                          other file access. "stream": the source is read ahead and
+                          its pages dropped once copied, and the copies are written
+                          back to DESTINATION every 32MiB and at the end of each
+                          file, so that a large sync neither evicts the cache of
+                          other programs nor leaves much data to be written at
+                          once. Default: cached."""))
+    parser.add_option("--watch", action="store_true", default=False,
+                      help=clean("""Keep running, with an index of SOURCE kept current
+                          through inotify, and sync each time DESTINATION appears
+                          or is mounted again. DESTINATION is only taken as
+                          available while it is in the file system it was in when
+                          first found, so that the mount point of a device that is
+                          unmounted is not filled. The device should thus be mounted
+                          when rmsync starts, or DESTINATION should be a directory
+                          that only exists while it is mounted."""))
+    parser.add_option("--resume", action="store_true", default=False,
+                      help=clean("""Finish the plan of an interrupted sync, recorded in
+                          DESTINATION, without scanning or selecting media again.
+                          SOURCE defaults to the one of the interrupted sync."""))
+    parser.add_option("--detect-renames", action="store_true", default=False,
+                      help=clean("""Recognize media in the destination that is in the
+                          source under another path, by size and sampled contents,
+                          and rename it in the destination instead of deleting and
+                          copying it again."""))
+    parser.add_option("--profile", action="store_true", default=False,
+                      help=clean("""Print the wall time, items, bytes, filesystem calls
+                          and peak memory of each phase of the sync."""))
+    parser.add_option("--stats-json", dest="stats_json", metavar="FILE", default=None,
+                      help="Write the measurements of each phase of the sync to FILE as JSON.")
+    parser.add_option("--write-plan", dest="write_plan", metavar="FILE", default=None,
+                      help=clean("""Scan and select media, then write the items to delete
+                          and to copy to FILE instead of changing DESTINATION.
+                          The plan can be applied later with --apply-plan."""))
+    parser.add_option("--apply-plan", dest="apply_plan", metavar="FILE", default=None,
+                      help=clean("""Apply the plan written to FILE by --write-plan,
+                          without scanning or selecting media again. The plan is
+                          refused if any of its items changed since it was computed.
+                          SOURCE defaults to the one of the plan."""))
+    parser.add_option("--refresh-albums", action="store_true", default=False,
+                      help=clean("""Update the albums that stay in DESTINATION with the
+                          files added, changed or removed in SOURCE, comparing
+                          their files by size and modification time. Only the
+                          differing files are copied or deleted."""))
+    parser.add_option("--also-dest", metavar="DIR[,free=FREE][,keep=KEEP][,jobs=JOBS]", action="append", dest="also_dest", default=[],
+                      help=clean("""Another destination media directory, filled from the
+                          same scan of SOURCE. FREE, KEEP and JOBS are as in --free,
+                          --keep and --copy-jobs, and default to their values. The
+                          destinations are written at the same time."""))
     
     (options, args) = parser.parse_args()
     
@@ -131,51 +264,215 @@ def process_config_file(options):
                 single_option(option, arg, 'dst_dir')
             elif option in ('free', 'keep'):
                 single_option(option, arg, option)
+            elif option == 'scan-index':
+                single_option(option, arg, 'scan_index')
+            elif option == 'scan-jobs':
+                single_option(option, arg, 'scan_jobs')
+            elif option == 'seed':
+                single_option(option, arg, 'seed')
+            elif option == 'strategy':
+                single_option(option, arg, 'strategy')
+            elif option == 'copy-jobs':
+                single_option(option, arg, 'copy_jobs')
+            elif option == 'copy-buffer':
+                single_option(option, arg, 'copy_buffer')
+            elif option == 'copy-order':
+                single_option(option, arg, 'copy_order')
+            elif option == 'watch':
+                bool_option(option, arg, 'watch')
+            elif option == 'history':
+                bool_option(option, arg, 'history')
+            elif option == 'verify':
+                bool_option(option, arg, 'verify')
+            elif option == 'check':
+                bool_option(option, arg, 'check')
+            elif option == 'check-size':
+                single_option(option, arg, 'check_size')
+            elif option == 'copy-io':
+                single_option(option, arg, 'copy_io')
             elif option == 'ignore':
                 list_option(option, arg, 'ignore')
             elif option == 'is-album':
                 list_option(option, arg, 'forced_albums')
             elif option == 'is-not-album':
                 list_option(option, arg, 'not_albums')
+            elif option == 'also-dest':
+                list_option(option, arg, 'also_dest')
             elif option == 'dry-run':
                 bool_option(option, arg, 'dry_run')
             elif option == 'mixed-mode':
                 bool_option(option, arg, 'mixed_mode')
             elif option == 'delete-in-dst-only':
                 bool_option(option, arg, 'delete_in_dst_only')
+            elif option == 'rescan':
+                bool_option(option, arg, 'rescan')
+            elif option == 'resume':
+                bool_option(option, arg, 'resume')
+            elif option == 'detect-renames':
+                bool_option(option, arg, 'detect_renames')
+            elif option == 'profile':
+                bool_option(option, arg, 'profile')
+            elif option == 'stats-json':
+                single_option(option, arg, 'stats_json')
+            elif option == 'write-plan':
+                single_option(option, arg, 'write_plan')
+            elif option == 'apply-plan':
+                single_option(option, arg, 'apply_plan')
+            elif option == 'refresh-albums':
+                bool_option(option, arg, 'refresh_albums')
             else:
                 sys.exit('"%s" is not a valid config file option' % option)
     rms.debug.log()
 
 
+def parse_free(free):
+    """Returns the (free, free_type) pair of a --free value."""
+    if free is None:
+        return (None, 'CURRENT')
+    else:
+        try:
+            return (rms.text.parse_percent(free), 'PERCENT')
+        except ValueError:
+            return (rms.text.parse_bytesize(free), 'BYTES')
+
+
+def parse_keep(keep):
+    """Returns the (keep, keep_is_percent) pair of a --keep value."""
+    if keep is None:
+        return (0, False)
+    else:
+        try:
+            return (rms.text.parse_percent(keep), True)
+        except ValueError:
+            return (int(keep), False)
+
+
+def parse_dest(spec, options):
+    """Returns the settings of an --also-dest value as a dict of options
+    attributes. The free, keep and jobs settings default to the ones in
+    options, which must have been parsed already."""
+    parts = spec.split(',')
+    settings = {
+        'dst_dir': parts[0],
+        'free': options.free,
+        'free_type': options.free_type,
+        'keep': options.keep,
+        'keep_is_percent': options.keep_is_percent,
+        'copy_jobs': options.copy_jobs,
+    }
+    for part in parts[1:]:
+        (name, _, value) = part.partition('=')
+        name = name.strip()
+        value = value.strip()
+        try:
+            if name == 'free':
+                (settings['free'], settings['free_type']) = parse_free(value)
+            elif name == 'keep':
+                (settings['keep'], settings['keep_is_percent']) = parse_keep(value)
+            elif name == 'jobs':
+                settings['copy_jobs'] = int(value)
+                if settings['copy_jobs'] < 1:
+                    raise ValueError()
+            else:
+                sys.exit('Invalid setting "%s" in destination: %s' % (name, spec))
+        except ValueError:
+            sys.exit('Invalid %s value "%s" in destination: %s' % (name, value, spec))
+    return settings
+
+
 def check_options(options):
     if options.dst_dir is None:
         sys.exit("DESTINATION not specified")
     
-    if options.src_dir is None:
+    if options.src_dir is None and not options.resume and options.apply_plan is None and not options.check:
         sys.exit("SOURCE not specified")
     
+    if options.resume and options.apply_plan is not None:
+        sys.exit("--resume and --apply-plan cannot be used together")
+    
+    if options.write_plan is not None:
+        if options.resume or options.apply_plan is not None:
+            sys.exit("--write-plan cannot be used with --resume or --apply-plan")
+        if options.detect_renames or options.delete_in_dst_only:
+            sys.exit("--write-plan cannot be used with options that change DESTINATION while planning")
+    
     
-    if options.free is None:
-        options.free_type = 'CURRENT'
+    (options.free, options.free_type) = parse_free(options.free)
+    (options.keep, options.keep_is_percent) = parse_keep(options.keep)
+    
+    if options.scan_jobs is None:
+        options.scan_jobs = 1
     else:
         try:
-            options.free = rms.text.parse_percent(options.free)
-            options.free_type = 'PERCENT'
+            options.scan_jobs = int(options.scan_jobs)
         except ValueError:
-            options.free = rms.text.parse_bytesize(options.free)
-            options.free_type = 'BYTES'
+            sys.exit("Invalid number of scan jobs: %s" % options.scan_jobs)
+        if options.scan_jobs < 1:
+            sys.exit("The number of scan jobs must be at least 1")
+    
+    if options.seed is not None:
+        try:
+            options.seed = int(options.seed)
+        except ValueError:
+            sys.exit("Invalid random seed: %s" % options.seed)
+    
+    if options.strategy is None:
+        options.strategy = 'random'
+    elif options.strategy not in ('random', 'fill'):
+        sys.exit("Invalid selection strategy: %s" % options.strategy)
     
-    if options.keep is None:
-        options.keep = 0
-        options.keep_is_percent = False
+    if options.copy_jobs is None:
+        options.copy_jobs = 1
     else:
         try:
-            options.keep = rms.text.parse_percent(options.keep)
-            options.keep_is_percent = True
+            options.copy_jobs = int(options.copy_jobs)
         except ValueError:
-            options.keep = int(options.keep)
-            options.keep_is_percent = False
+            sys.exit("Invalid number of copy jobs: %s" % options.copy_jobs)
+        if options.copy_jobs < 1:
+            sys.exit("The number of copy jobs must be at least 1")
+    
+    options.also_dest = [parse_dest(spec, options) for spec in options.also_dest]
+    if options.also_dest:
+        if options.resume or options.apply_plan is not None or options.write_plan is not None:
+            sys.exit("--also-dest cannot be used with --resume, --apply-plan or --write-plan")
+        dst_dirs = [os.path.realpath(options.dst_dir)]
+        for settings in options.also_dest:
+            dst_dir = os.path.realpath(settings['dst_dir'])
+            if dst_dir in dst_dirs:
+                sys.exit("Destination given more than once: %s" % settings['dst_dir'])
+            dst_dirs.append(dst_dir)
+    
+    if options.copy_buffer is None:
+        options.copy_buffer = 512 * 1024 * 1024
+    else:
+        try:
+            options.copy_buffer = rms.text.parse_bytesize(options.copy_buffer)
+        except ValueError:
+            sys.exit("Invalid copy buffer size: %s" % options.copy_buffer)
+    
+    if options.watch:
+        if options.resume or options.apply_plan is not None or options.write_plan is not None:
+            sys.exit("--watch cannot be used with --resume, --apply-plan or --write-plan")
+        if not rms.inotify.is_available():
+            sys.exit("--watch requires inotify, which is not available")
+    
+    if options.check:
+        if options.resume or options.apply_plan is not None or options.write_plan is not None or options.watch:
+            sys.exit("--check cannot be used with --resume, --apply-plan, --write-plan or --watch")
+    
+    if options.check_size is not None:
+        try:
+            options.check_size = rms.text.parse_bytesize(options.check_size)
+        except ValueError:
+            sys.exit("Invalid check size: %s" % options.check_size)
+    
+    if options.copy_order is not None and options.copy_order not in rms.locality.ORDERS:
+        sys.exit("Invalid copy order: %s" % options.copy_order)
+    
+    if options.copy_io is None:
+        options.copy_io = 'cached'
+    elif options.copy_io not in ('cached', 'stream'):
+        sys.exit("Invalid copy I/O mode: %s" % options.copy_io)
     
     if options.dry_run:
-        rms.files.delete = rms.files.copy = lambda *args:None
+        rms.files.delete = rms.files.remove = rms.files.copy = rms.files.rename = rms.files.apply_album_delta = lambda *args:None
@@ -0,0 +1,111 @@
+import threading
+import time
+
+import rms.text
+
+
+class Progress(object):
+    """Byte-level progress of a sync, or of a phase, with a smoothed throughput and an
+    estimated time to completion.
+    
+    advance() may be called from several threads. If given, report is called
+    from advance() with the Progress when its status has not been taken for
+    REPORT_INTERVAL seconds, so that long copies show their progress.
+    """
+    
+    # Weight of the most recent throughput measurement
+    SMOOTHING = 0.3
+    # Minimum time between throughput measurements, in seconds
+    INTERVAL = 0.5
+    # Maximum time without reporting the status, in seconds
+    REPORT_INTERVAL = 5
+    
+    def __init__(self, total_size, clock=time.time, report=None):
+        self.total_size = total_size
+        self.done_size = 0
+        self.clock = clock
+        self.start_time = clock()
+        self.sample_time = self.start_time
+        self.sample_size = 0
+        self.rate = None
+        self.report = report
+        self.status_time = self.start_time
+        self.lock = threading.Lock()
+    
+    def advance(self, size):
+        with self.lock:
+            self.done_size += size
+            now = self.clock()
+            elapsed = now - self.sample_time
+            if elapsed >= self.INTERVAL:
+                rate = (self.done_size - self.sample_size) / elapsed
+                if self.rate is None:
+                    self.rate = rate
+                else:
+                    self.rate = self.SMOOTHING * rate + (1 - self.SMOOTHING) * self.rate
+                self.sample_time = now
+                self.sample_size = self.done_size
+            report = self.report is not None and now - self.status_time >= self.REPORT_INTERVAL
+            if report:
+                self.status_time = now
+        if report:
+            self.report(self)
+    
+    def item(self, size):
+        """Returns the ItemProgress of an item of the given size."""
+        return ItemProgress(self, size)
+    
+    def elapsed(self):
+        return self.clock() - self.start_time
+    
+    def current_rate(self):
+        """Returns the smoothed throughput in bytes per second, or None if it
+        is still unknown."""
+        if self.rate is not None:
+            return self.rate
+        elapsed = self.elapsed()
+        if self.done_size > 0 and elapsed > 0:
+            return self.done_size / elapsed
+        return None
+    
+    def status(self):
+        self.status_time = self.clock()
+        text = '%s/%s %s' % (
+            rms.text.format_bytesize(self.done_size),
+            rms.text.format_bytesize(self.total_size),
+            rms.text.format_percent(self.done_size, self.total_size) if self.total_size else '100.0%',
+        )
+        
+        rate = self.current_rate()
+        if rate:
+            eta = max(self.total_size - self.done_size, 0) / rate
+            text += ', %s/s, ETA %s' % (rms.text.format_bytesize(int(rate)), rms.text.format_duration(eta))
+        
+        return '[' + text + ']'
+    
+    def summary(self):
+        elapsed = self.elapsed()
+        text = '%s in %s' % (rms.text.format_bytesize(self.done_size), rms.text.format_duration(elapsed))
+        if elapsed > 0:
+            text += ' (%s/s)' % rms.text.format_bytesize(int(self.done_size / elapsed))
+        return text
+
+
+class ItemProgress(object):
+    """Progress of a single item, advanced with the bytes copied as they are.
+    
+    finish() accounts for the difference between the bytes advanced and the
+    size of the item in the plan, which counts whole allocated blocks.
+    """
+    
+    def __init__(self, progress, size):
+        self.progress = progress
+        self.size = size
+        self.done_size = 0
+    
+    def advance(self, size):
+        self.done_size += size
+        self.progress.advance(size)
+    
+    def finish(self):
+        self.progress.advance(self.size - self.done_size)
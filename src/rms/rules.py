@@ -0,0 +1,103 @@
+"""Matching of relpaths against the --ignore, --is-album and --is-not-album
+rules.
+
+A rule is a relpath whose components may be glob patterns, as in fnmatch,
+each one matching within a single component. A component with glob
+characters also matches itself literally, so that a rule written for a
+name like "Album [Live]" keeps matching it. A last component "**" makes the
+rule match the directory and everything below it.
+
+The rules are kept in a trie of path components, so matching a relpath
+takes time in proportion to its depth and to the glob components met on
+the way, not to the number of rules.
+"""
+import fnmatch
+import re
+
+
+GLOB_CHARS = re.compile(r'[*?[]')
+
+
+class Node(object):
+    __slots__ = ('children', 'globs', 'terminal', 'subtree')
+    
+    def __init__(self):
+        # Component -> Node
+        self.children = {}
+        # (pattern, match function, Node) tuples
+        self.globs = []
+        # A rule ends here
+        self.terminal = False
+        # A rule ending in "**" ends here
+        self.subtree = False
+
+
+class PathRules(object):
+    """Set of rules supporting "relpath in rules"."""
+    
+    def __init__(self, rules=()):
+        self.rules = []
+        self.root = Node()
+        for rule in rules:
+            self.add(rule)
+    
+    def __len__(self):
+        return len(self.rules)
+    
+    def __iter__(self):
+        return iter(self.rules)
+    
+    def __repr__(self):
+        return 'PathRules(%r)' % self.rules
+    
+    def add(self, rule):
+        self.rules.append(rule)
+        
+        parts = rule.strip('/').split('/')
+        if parts == ['']:
+            parts = []
+        self.add_parts(self.root, parts)
+    
+    def add_parts(self, node, parts):
+        for (i, part) in enumerate(parts):
+            if part == '**' and i == len(parts) - 1:
+                node.subtree = True
+                return
+            
+            if GLOB_CHARS.search(part):
+                # Names like "Album [Live]" are common, so a component with
+                # glob characters also matches itself literally
+                self.add_parts(node.children.setdefault(part, Node()), parts[i + 1:])
+                for (pattern, _, child) in node.globs:
+                    if pattern == part:
+                        node = child
+                        break
+                else:
+                    child = Node()
+                    node.globs.append((part, re.compile(fnmatch.translate(part)).match, child))
+                    node = child
+            else:
+                node = node.children.setdefault(part, Node())
+        node.terminal = True
+    
+    def __contains__(self, relpath):
+        if not self.rules:
+            return False
+        parts = relpath.split('/') if relpath else []
+        return self.match(self.root, parts, 0)
+    
+    def match(self, node, parts, i):
+        while True:
+            if node.subtree:
+                return True
+            if i == len(parts):
+                return node.terminal
+            
+            part = parts[i]
+            child = node.children.get(part)
+            if child is not None and self.match(child, parts, i + 1):
+                return True
+            for (_, match, child) in node.globs:
+                if match(part) and self.match(child, parts, i + 1):
+                    return True
+            return False
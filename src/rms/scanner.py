@@ -1,8 +1,22 @@
+from collections import namedtuple
 from itertools import chain
+from multiprocessing.pool import ThreadPool
+import os
 import os.path
+import stat
 
 from rms.media import Media
 import rms.debug
+import rms.dirent
+import rms.rules
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 
 MEDIA_EXTS = (
@@ -26,11 +40,122 @@ def is_album_media_file(filename):
     return is_media_file(filename)
 
 
+def allocated_size(size, block_size):
+    """Returns the space taken by a file of the given size in a device whose
+    file system allocates it in blocks of block_size bytes. If block_size is
+    None, returns the size itself."""
+    if not block_size:
+        return size
+    return -(-size // block_size) * block_size
+
+
+# files: dict mapping the name of each album media file to its size.
+# dirs: list of subdirectory names.
+# links: the subset of dirs that are symbolic links.
+DirListing = namedtuple('DirListing', 'files,dirs,links')
+
+def read_dir(dir_fullpath):
+    """Returns the DirListing of a directory.
+    
+    The entry types come from the directory itself, and only the album media
+    files and the symbolic links are stat'ed. This is done with scandir()
+    where available (Python 3.5, or the scandir package in Python 2), or
+    else with readdir() through ctypes on Linux. Otherwise, or for entries of
+    unknown type, each entry is lstat'ed once, and stat'ed again only if it
+    is a symbolic link. Entries that vanish while being read are left out.
+    """
+    if scandir is not None:
+        return read_dir_entries(dir_fullpath)
+    
+    listing = DirListing(files={}, dirs=[], links=[])
+    if rms.dirent.is_available():
+        for (item, type) in rms.dirent.list_dir(dir_fullpath):
+            add_entry(listing, dir_fullpath, item, type)
+    else:
+        for item in os.listdir(dir_fullpath):
+            add_entry(listing, dir_fullpath, item)
+    return listing
+
+
+def add_entry(listing, dir_fullpath, item, type=rms.dirent.DT_UNKNOWN):
+    """Adds an entry to the listing being read, given its type as a DT_*
+    constant if it is known."""
+    if type == rms.dirent.DT_DIR:
+        listing.dirs.append(item)
+        return
+    if type == rms.dirent.DT_REG and not is_album_media_file(item):
+        return
+    
+    item_fullpath = os.path.join(dir_fullpath, item)
+    try:
+        if type == rms.dirent.DT_UNKNOWN:
+            st = os.lstat(item_fullpath)
+            is_link = stat.S_ISLNK(st.st_mode)
+            if is_link:
+                st = os.stat(item_fullpath)
+        elif type in (rms.dirent.DT_REG, rms.dirent.DT_LNK):
+            is_link = type == rms.dirent.DT_LNK
+            st = os.stat(item_fullpath)
+        else:
+            # Devices, pipes and sockets
+            return
+    except OSError:
+        # Removed meanwhile, or a broken link
+        return
+    
+    if stat.S_ISREG(st.st_mode):
+        if is_album_media_file(item):
+            listing.files[item] = st.st_size
+    elif stat.S_ISDIR(st.st_mode):
+        listing.dirs.append(item)
+        if is_link:
+            listing.links.append(item)
+
+
+def read_dir_entries(dir_fullpath):
+    """read_dir() with scandir()."""
+    files = {}
+    dirs = []
+    links = []
+    for entry in scandir(dir_fullpath):
+        try:
+            if entry.is_dir():
+                dirs.append(entry.name)
+                if entry.is_symlink():
+                    links.append(entry.name)
+            elif entry.is_file() and is_album_media_file(entry.name):
+                files[entry.name] = entry.stat().st_size
+        except OSError:
+            # Removed meanwhile
+            continue
+    return DirListing(files=files, dirs=dirs, links=links)
+
+
 class Scanner(object):
-    def __init__(self, ignore, forced_albums, not_albums):
-        self.ignore = ignore
-        self.forced_albums = forced_albums
-        self.not_albums = not_albums
+    """Finds the media items in a directory.
+    
+    If block_size is given, the item sizes are the space the items would
+    take in a device with that allocation unit: each file rounded up to a
+    whole number of blocks, and a block for each directory of an album. The
+    listings kept in the index hold the actual file sizes.
+    """
+    
+    def __init__(self, ignore, forced_albums, not_albums, index=None, jobs=1, block_size=None):
+        self.ignore = rms.rules.PathRules(ignore)
+        self.forced_albums = rms.rules.PathRules(forced_albums)
+        self.not_albums = rms.rules.PathRules(not_albums)
+        self.index = index
+        self.block_size = block_size
+        if jobs > 1:
+            self.pool = ThreadPool(jobs)
+        else:
+            self.pool = None
+    
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
     
     def is_album(self, dir_relpath):
         return dir_relpath in self.forced_albums
@@ -40,7 +165,11 @@ class Scanner(object):
     
     def scan(self, media_dir):
         """Returns a Media object."""
+        if self.index is not None:
+            self.index.add_root(media_dir)
         items = self.scan_dir(media_dir, '', level=0)
+        if self.pool is not None:
+            items = self.size_albums(media_dir, list(items))
         return Media((item.relpath, item) for item in items)
     
     def scan_dir(self, media_dir, dir_relpath, level):
@@ -66,7 +195,19 @@ class Scanner(object):
             else:
                 return self.scan_album(media_dir, dir_relpath)
     
-    def scan_file(self, media_dir, file_relpath):
+    def list_dir(self, dir_fullpath):
+        """Returns a DirListing, taken from the index if the directory is unchanged."""
+        if self.index is None:
+            return read_dir(dir_fullpath)
+        
+        mtime = os.stat(dir_fullpath).st_mtime
+        listing = self.index.get(dir_fullpath, mtime)
+        if listing is None:
+            listing = read_dir(dir_fullpath)
+            self.index.put(dir_fullpath, mtime, listing)
+        return listing
+    
+    def scan_file(self, media_dir, file_relpath, file_size):
         """Generator of Media.Item file objects."""
         if file_relpath in self.ignore:
             rms.debug.log("Ignoring file:", file_relpath)
@@ -74,34 +215,66 @@ class Scanner(object):
         
         _, filename = os.path.split(file_relpath)
         if is_media_file(filename):
-            file_fullpath = os.path.join(media_dir, file_relpath)
-            file_size = os.path.getsize(file_fullpath)
-            yield Media.Item(type='FILE', relpath=file_relpath, size=file_size)
+            yield Media.Item(type='FILE', relpath=file_relpath, size=allocated_size(file_size, self.block_size))
     
     def scan_album(self, media_dir, album_relpath):
-        """Generator of a Media.Item album object."""
-        album_fullpath = os.path.join(media_dir, album_relpath)
+        """Generator of a Media.Item album object.
         
-        total_size = 0
-        for (dir_fullpath, _, files) in os.walk(album_fullpath):
-            for file in files:
-                _, filename = os.path.split(file)
-                if is_album_media_file(filename):
-                    file_fullpath = os.path.join(dir_fullpath, file)
-                    total_size += os.path.getsize(file_fullpath)
+        When scanning concurrently, the album size is left as None, to be
+        computed later by size_albums().
+        """
+        if self.pool is not None:
+            yield Media.Item(type='ALBUM', relpath=album_relpath, size=None)
+            return
         
+        total_size = self.album_size(media_dir, album_relpath)
         if total_size:
             yield Media.Item(type='ALBUM', relpath=album_relpath, size=total_size)
     
+    def size_albums(self, media_dir, items):
+        """Computes the pending album sizes on the thread pool. Returns a list
+        of Media.Item objects."""
+        albums = [item for item in items if item.size is None]
+        sizes = self.pool.map(lambda album: self.album_size(media_dir, album.relpath), albums)
+        
+        items = [item for item in items if item.size is not None]
+        items.extend(album._replace(size=size) for (album, size) in zip(albums, sizes) if size)
+        return items
+    
+    def album_size(self, media_dir, album_relpath):
+        album_fullpath = os.path.join(media_dir, album_relpath)
+        
+        total_size = 0
+        dir_count = 0
+        pending = [album_fullpath]
+        while pending:
+            dir_fullpath = pending.pop()
+            try:
+                listing = self.list_dir(dir_fullpath)
+            except OSError:
+                # Unreadable directories are skipped, as os.walk() does
+                continue
+            dir_count += 1
+            if self.block_size:
+                total_size += sum(allocated_size(size, self.block_size) for size in listing.files.itervalues())
+            else:
+                total_size += sum(listing.files.itervalues())
+            pending.extend(os.path.join(dir_fullpath, dir) for dir in listing.dirs if dir not in listing.links)
+        
+        if total_size and self.block_size:
+            # The directories themselves
+            total_size += dir_count * self.block_size
+        return total_size
+    
     def scan_not_album(self, media_dir, dir_relpath, level):
         """Generator of generators of Media.Item objects."""
         full_path = os.path.join(media_dir, dir_relpath)
-        for item in os.listdir(full_path):
-            item_fullpath = os.path.join(full_path, item)
+        listing = self.list_dir(full_path)
+        for (item, size) in listing.files.iteritems():
+            item_relpath = os.path.join(dir_relpath, item)
+            gen = self.scan_file(media_dir, item_relpath, size)
+            yield gen
+        for item in listing.dirs:
             item_relpath = os.path.join(dir_relpath, item)
-            if os.path.isfile(item_fullpath):
-                gen = self.scan_file(media_dir, item_relpath)
-                yield gen
-            elif os.path.isdir(item_fullpath):
-                gen = self.scan_dir(media_dir, item_relpath, level + 1)
-                yield gen
+            gen = self.scan_dir(media_dir, item_relpath, level + 1)
+            yield gen
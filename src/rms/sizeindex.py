@@ -0,0 +1,84 @@
+"""A sorted set of items, for best-fit searches by size."""
+import bisect
+
+
+class SizeIndex(object):
+    """Set of (size, relpath) items, kept in order, that finds the largest
+    item not larger than a given size.
+    
+    The items are kept in sorted blocks of about BLOCK_SIZE items, so that
+    adding or removing one only shifts its own block, instead of every item
+    after it in a single list.
+    """
+    
+    BLOCK_SIZE = 1000
+    
+    def __init__(self, items=()):
+        items = sorted(items)
+        self.blocks = [items[i:i + self.BLOCK_SIZE] for i in range(0, len(items), self.BLOCK_SIZE)]
+        # The sizes of the items of each block, for the searches by size
+        self.size_blocks = [[size for (size, _) in block] for block in self.blocks]
+        # The last item of each block, and its size
+        self.maxes = [block[-1] for block in self.blocks]
+        self.max_sizes = [size for (size, _) in self.maxes]
+        self.count = len(items)
+    
+    def __len__(self):
+        return self.count
+    
+    def add(self, item):
+        if not self.blocks:
+            self.blocks.append([item])
+            self.size_blocks.append([item[0]])
+            self.maxes.append(item)
+            self.max_sizes.append(item[0])
+            self.count += 1
+            return
+        
+        b = min(bisect.bisect_left(self.maxes, item), len(self.blocks) - 1)
+        block = self.blocks[b]
+        i = bisect.bisect_left(block, item)
+        block.insert(i, item)
+        self.size_blocks[b].insert(i, item[0])
+        self.count += 1
+        self.maxes[b] = block[-1]
+        self.max_sizes[b] = block[-1][0]
+        
+        if len(block) > 2 * self.BLOCK_SIZE:
+            sizes = self.size_blocks[b]
+            self.blocks[b:b + 1] = [block[:self.BLOCK_SIZE], block[self.BLOCK_SIZE:]]
+            self.size_blocks[b:b + 1] = [sizes[:self.BLOCK_SIZE], sizes[self.BLOCK_SIZE:]]
+            self.maxes.insert(b, block[self.BLOCK_SIZE - 1])
+            self.max_sizes.insert(b, sizes[self.BLOCK_SIZE - 1])
+    
+    def remove(self, item):
+        """Removes an item, which must be in the set."""
+        b = bisect.bisect_left(self.maxes, item)
+        block = self.blocks[b]
+        i = bisect.bisect_left(block, item)
+        assert block[i] == item
+        del block[i]
+        del self.size_blocks[b][i]
+        self.count -= 1
+        
+        if block:
+            self.maxes[b] = block[-1]
+            self.max_sizes[b] = block[-1][0]
+        else:
+            del self.blocks[b]
+            del self.size_blocks[b]
+            del self.maxes[b]
+            del self.max_sizes[b]
+    
+    def largest_at_most(self, size):
+        """Returns the last of the items not larger than size, or None if
+        there is none."""
+        # The first block with a larger item
+        b = bisect.bisect_right(self.max_sizes, size)
+        if b < len(self.blocks):
+            i = bisect.bisect_right(self.size_blocks[b], size)
+            if i > 0:
+                return self.blocks[b][i - 1]
+        if b > 0:
+            return self.maxes[b - 1]
+        return None
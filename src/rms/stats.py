@@ -0,0 +1,120 @@
+"""Per-phase measurements: wall time, items, bytes, filesystem calls and peak
+memory.
+
+Nothing is measured unless ENABLED is set; phase() then returns a shared
+object that does nothing.
+"""
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import rms.syscalls
+import rms.text
+
+
+ENABLED = False
+
+phases = []
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+    rms.syscalls.install()
+
+
+def maxrss_bytes(maxrss):
+    """Converts the ru_maxrss of a resource usage to bytes."""
+    if sys.platform == 'darwin':
+        return maxrss
+    else:
+        return maxrss * 1024
+
+
+def peak_rss():
+    """Peak resident memory of the process so far, in bytes, or None."""
+    if resource is None:
+        return None
+    return maxrss_bytes(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+class Phase(object):
+    def __init__(self, name):
+        self.name = name
+        self.items = None
+        self.size = None
+    
+    def set(self, items=None, size=None):
+        """Sets the number of items and of bytes processed by the phase."""
+        self.items = items
+        self.size = size
+    
+    def __enter__(self):
+        self.fs_calls_before = rms.syscalls.snapshot()
+        self.start = time.time()
+        return self
+    
+    def __exit__(self, type, value, traceback):
+        wall = time.time() - self.start
+        fs_calls = rms.syscalls.difference(rms.syscalls.snapshot(), self.fs_calls_before)
+        phases.append({
+            'phase': self.name,
+            'wall': wall,
+            'items': self.items,
+            'bytes': self.size,
+            'fs_calls': sum(fs_calls.itervalues()),
+            'fs_calls_by_function': fs_calls,
+            'peak_rss': peak_rss(),
+            'completed': type is None,
+        })
+
+
+class NullPhase(object):
+    def set(self, items=None, size=None):
+        pass
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, type, value, traceback):
+        pass
+
+NULL_PHASE = NullPhase()
+
+
+def phase(name):
+    """Returns a context manager that measures the phase, if enabled."""
+    if ENABLED:
+        return Phase(name)
+    else:
+        return NULL_PHASE
+
+
+def write_json(filename):
+    with open(filename, 'w') as f:
+        json.dump({'phases': phases}, f, indent=2)
+
+
+def print_report():
+    print 'Profile:'
+    for p in phases:
+        if p['items'] is not None:
+            items = '%d items' % p['items']
+        else:
+            items = ''
+        if p['bytes'] is not None:
+            size = rms.text.format_bytesize(p['bytes'])
+        else:
+            size = ''
+        if p['peak_rss'] is not None:
+            rss = rms.text.format_bytesize(p['peak_rss'])
+        else:
+            rss = '?'
+        print "\t%-16s %9.3fs %12s %10s %8d fs calls, peak RSS %s" % (
+            p['phase'], p['wall'], items, size, p['fs_calls'], rss)
+    print
@@ -0,0 +1,80 @@
+"""Counts the filesystem calls made through the os module and open().
+
+The counting wrappers replace the functions in the os module, so calls
+made by any module that looks them up at call time (os.path, shutil,
+os.walk...) are counted too. Reads and writes done by file objects, and
+the calls made by the scandir module or through ctypes (rms.dirent,
+rms.fastcopy), are not visible from Python and are not counted.
+"""
+import __builtin__
+import os
+import threading
+
+
+FUNCTIONS = (
+    'stat',
+    'lstat',
+    'fstat',
+    'statvfs',
+    'listdir',
+    'open',
+    'read',
+    'write',
+    'lseek',
+    'fsync',
+    'mkdir',
+    'rmdir',
+    'remove',
+    'unlink',
+    'rename',
+    'link',
+    'chmod',
+    'utime',
+)
+
+counts = {}
+_originals = {}
+_lock = threading.Lock()
+
+
+def _counting(name, function):
+    def wrapper(*args, **kwargs):
+        with _lock:
+            counts[name] = counts.get(name, 0) + 1
+        return function(*args, **kwargs)
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+
+
+def install():
+    if _originals:
+        return
+    
+    for name in FUNCTIONS:
+        function = getattr(os, name, None)
+        if function is not None:
+            _originals['os.' + name] = function
+            setattr(os, name, _counting(name, function))
+    
+    _originals['open'] = __builtin__.open
+    __builtin__.open = _counting('builtin open', __builtin__.open)
+
+
+def uninstall():
+    for (name, function) in _originals.iteritems():
+        if name == 'open':
+            __builtin__.open = function
+        else:
+            setattr(os, name[len('os.'):], function)
+    _originals.clear()
+
+
+def snapshot():
+    with _lock:
+        return dict(counts)
+
+
+def difference(after, before):
+    return dict((name, count - before.get(name, 0)) for (name, count) in after.iteritems()
+                if count != before.get(name, 0))
@@ -53,3 +53,10 @@ def format_bytesize(value):
 
 def format_percent(value, out_of):
     return '%.1f%%' % (100.0 * value / out_of)
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    (minutes, seconds) = divmod(seconds, 60)
+    (hours, minutes) = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
@@ -0,0 +1,193 @@
+"""Verified copies: the contents are hashed while copied, then read back from
+the destination device and compared. The hashes are kept in a manifest in
+the destination directory, so that the device can be checked again later
+without the source.
+"""
+import cPickle as pickle
+import errno
+import hashlib
+import os
+import os.path
+import threading
+import time
+
+import rms.debug
+import rms.fastcopy
+
+
+MANIFEST_FILENAME = '.rmsync-manifest'
+
+FORMAT_VERSION = 1
+
+# Copies of a file tried before giving up
+ATTEMPTS = 2
+
+# Seconds between saves of the manifest while files are added, so that an
+# interrupted sync keeps the hashes of the files it verified
+SAVE_INTERVAL = 30
+
+
+class VerificationError(IOError):
+    pass
+
+
+def copy_file(src, dst, progress=None):
+    """Copies with a read/write loop, hashing the contents on the way, and
+    syncs dst. Returns the (digest, size) pair. If given, progress is called
+    with the number of bytes of each chunk copied."""
+    h = hashlib.md5()
+    size = 0
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            rms.fastcopy.preallocate(fdst.fileno(), os.fstat(fsrc.fileno()).st_size)
+            if rms.fastcopy.streaming:
+                stream = rms.fastcopy.Stream(fsrc.fileno(), fdst.fileno())
+            else:
+                stream = None
+            while True:
+                data = fsrc.read(rms.fastcopy.CHUNK_SIZE)
+                if not data:
+                    break
+                h.update(data)
+                fdst.write(data)
+                size += len(data)
+                if stream is not None:
+                    fdst.flush()
+                    stream.advance()
+                if progress is not None:
+                    progress(len(data))
+            fdst.flush()
+            if stream is not None:
+                stream.finish()
+            else:
+                os.fsync(fdst.fileno())
+    return (h.hexdigest(), size)
+
+
+def hash_file(path):
+    """Hashes the contents of the file as stored in the device, dropping its
+    cached pages first where possible."""
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        rms.fastcopy.drop_cache(f.fileno())
+        while True:
+            data = f.read(rms.fastcopy.CHUNK_SIZE)
+            if not data:
+                break
+            h.update(data)
+        if rms.fastcopy.streaming:
+            rms.fastcopy.drop_cache(f.fileno())
+    return h.hexdigest()
+
+
+def copy_verified(src, dst, progress=None):
+    """Copies src to dst and checks the copy, trying again if it does not
+    match. Returns the (digest, size) pair. Only the first copy reports its
+    progress."""
+    for _ in range(ATTEMPTS):
+        (digest, size) = copy_file(src, dst, progress)
+        if hash_file(dst) == digest:
+            return (digest, size)
+        progress = None
+    raise VerificationError(errno.EIO, 'Copy does not match the source after %d attempts' % ATTEMPTS, dst)
+
+
+class Manifest(object):
+    """Hash of each verified file in the destination, with its size and
+    modification time, to tell a file changed since by other means from a
+    corrupted one, and the time it was last checked."""
+    
+    def __init__(self, dst_dir):
+        self.dst_dir = dst_dir
+        self.filename = os.path.join(dst_dir, MANIFEST_FILENAME)
+        # file relpath -> (size, mtime, digest, checked time)
+        self.entries = {}
+        # file relpath -> (size, digest) of the files copied in this run
+        self.added = {}
+        self.lock = threading.Lock()
+        self.save_time = time.time()
+        self.load()
+    
+    def load(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                data = pickle.load(f)
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError) as e:
+            rms.debug.log("Manifest not loaded:", str(e))
+            return
+        
+        if data.get('version') == FORMAT_VERSION:
+            self.entries = data['entries']
+    
+    def save(self):
+        with self.lock:
+            self._save()
+    
+    def _save(self):
+        now = time.time()
+        for (relpath, (size, digest)) in self.added.iteritems():
+            try:
+                stat = os.stat(os.path.join(self.dst_dir, relpath))
+            except OSError:
+                continue
+            self.entries[relpath] = (size, stat.st_mtime, digest, now)
+        self.added.clear()
+        
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump({'version': FORMAT_VERSION, 'entries': self.entries}, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_filename, self.filename)
+        self.save_time = now
+    
+    def add(self, file_relpath, size, digest):
+        with self.lock:
+            self.added[file_relpath] = (size, digest)
+            if time.time() - self.save_time >= SAVE_INTERVAL:
+                self._save()
+    
+    def forget(self, item_relpaths):
+        """Removes the entries of the files of deleted items."""
+        item_relpaths = set(item_relpaths)
+        if not item_relpaths:
+            return
+        for relpath in self.entries.keys():
+            path = relpath
+            while path:
+                if path in item_relpaths:
+                    del self.entries[relpath]
+                    break
+                path = os.path.dirname(path)
+    
+    def oldest(self, max_size=None):
+        """Returns the files checked the longest ago, up to a total of
+        max_size bytes, but at least one."""
+        relpaths = sorted(self.entries, key=lambda relpath: self.entries[relpath][3])
+        if max_size is None:
+            return relpaths
+        
+        total_size = 0
+        for (i, relpath) in enumerate(relpaths):
+            total_size += self.entries[relpath][0]
+            if total_size > max_size and i > 0:
+                return relpaths[:i]
+        return relpaths
+    
+    def check(self, file_relpath):
+        """Reads a file back and compares it to its entry. Returns 'ok',
+        'corrupt', or 'changed' if the file was removed or changed by other
+        means, in which case the entry is dropped."""
+        (size, mtime, digest, _) = self.entries[file_relpath]
+        full_path = os.path.join(self.dst_dir, file_relpath)
+        try:
+            stat = os.stat(full_path)
+        except OSError:
+            del self.entries[file_relpath]
+            return 'changed'
+        if stat.st_size != size or stat.st_mtime != mtime:
+            del self.entries[file_relpath]
+            return 'changed'
+        
+        if hash_file(full_path) != digest:
+            return 'corrupt'
+        self.entries[file_relpath] = (size, mtime, digest, time.time())
+        return 'ok'
@@ -0,0 +1,226 @@
+"""An index of the source media that is kept current with inotify, so that a
+sync does not need to scan the source again.
+
+Every directory of the source is watched. A change in a directory inside an
+album only makes that album be sized again. A change in a directory that
+holds items (the root, the artist directories and the forced not-albums)
+makes its own listing be read again, scanning only the subdirectories that
+appeared in it.
+"""
+import errno
+import os
+import os.path
+
+import rms.inotify
+import rms.scanner
+
+
+WATCH_MASK = (rms.inotify.IN_CLOSE_WRITE | rms.inotify.IN_ATTRIB |
+              rms.inotify.IN_CREATE | rms.inotify.IN_DELETE |
+              rms.inotify.IN_MOVED_FROM | rms.inotify.IN_MOVED_TO |
+              rms.inotify.IN_DELETE_SELF | rms.inotify.IN_ONLYDIR)
+
+# Seconds without events after which the pending changes are applied, so
+# that a file being copied into the source is not looked at many times.
+SETTLE_TIME = 2
+
+# Rows of removed or changed items allowed in the table of the media, beyond
+# as many as the current items, before it is compacted
+COMPACT_SLACK = 1000
+
+
+def relpath_level(relpath):
+    if relpath == '':
+        return 0
+    return relpath.count('/') + 1
+
+
+def is_under(relpath, dir_relpath):
+    return dir_relpath == '' or relpath == dir_relpath or relpath.startswith(dir_relpath + '/')
+
+
+class LiveSource(object):
+    """Media of the source directory, updated from the inotify events."""
+    
+    def __init__(self, src_dir, ignore, forced_albums, not_albums, block_size=None):
+        self.src_dir = src_dir
+        # Without an index, which would not notice files changed in place,
+        # nor a pool, which leaves the album sizes to be computed later
+        self.scanner = rms.scanner.Scanner(ignore, forced_albums, not_albums, block_size=block_size)
+        self.inotify = rms.inotify.Inotify()
+        # wd -> dir relpath and back
+        self.watched = {}
+        self.watches = {}
+        self.dirty = set()
+        self.full_rescan = False
+        # (dir relpath, OSError) of the directories that could not be
+        # watched, as when the inotify watch limit is reached. Their changes
+        # go unnoticed, so the source must be scanned again with rescan().
+        self.watch_errors = []
+        
+        self.watch_tree('')
+        self.media = self.scanner.scan(src_dir)
+    
+    def close(self):
+        self.inotify.close()
+    
+    @property
+    def block_size(self):
+        return self.scanner.block_size
+    
+    def set_block_size(self, block_size):
+        """Sizes the media for another allocation unit, scanning the source
+        again."""
+        self.scanner.block_size = block_size
+        self.full_rescan = True
+        self.update()
+    
+    def watch_tree(self, dir_relpath):
+        for (dir_fullpath, dirs, _) in os.walk(os.path.join(self.src_dir, dir_relpath)):
+            relpath = os.path.relpath(dir_fullpath, self.src_dir)
+            if relpath == '.':
+                relpath = ''
+            try:
+                wd = self.inotify.add_watch(dir_fullpath, WATCH_MASK)
+            except OSError as e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    self.watch_errors.append((relpath, e))
+                # Else removed meanwhile
+                continue
+            self.watched[wd] = relpath
+            self.watches[relpath] = wd
+    
+    def unwatch_tree(self, dir_relpath):
+        for relpath in [relpath for relpath in self.watches if is_under(relpath, dir_relpath)]:
+            wd = self.watches.pop(relpath)
+            del self.watched[wd]
+            try:
+                self.inotify.rm_watch(wd)
+            except OSError:
+                # Already removed by the kernel
+                pass
+    
+    def wait(self, timeout):
+        """Waits up to timeout seconds for changes in the source, and applies
+        them once no more arrive for SETTLE_TIME seconds. Returns the number
+        of updated directories."""
+        events = self.inotify.read(timeout)
+        while events:
+            self.record(events)
+            events = self.inotify.read(SETTLE_TIME)
+        return self.update()
+    
+    def record(self, events):
+        for (wd, mask, cookie, name) in events:
+            if mask & rms.inotify.IN_Q_OVERFLOW:
+                self.full_rescan = True
+                continue
+            
+            dir_relpath = self.watched.get(wd)
+            if dir_relpath is None:
+                continue
+            if mask & rms.inotify.IN_IGNORED:
+                del self.watched[wd]
+                if self.watches.get(dir_relpath) == wd:
+                    del self.watches[dir_relpath]
+                continue
+            
+            self.dirty.add(dir_relpath)
+            if mask & rms.inotify.IN_ISDIR and name:
+                child_relpath = os.path.join(dir_relpath, name)
+                if mask & (rms.inotify.IN_CREATE | rms.inotify.IN_MOVED_TO):
+                    self.watch_tree(child_relpath)
+                elif mask & (rms.inotify.IN_DELETE | rms.inotify.IN_MOVED_FROM):
+                    self.unwatch_tree(child_relpath)
+    
+    def update(self):
+        if self.full_rescan:
+            self.unwatch_tree('')
+            self.watch_errors = []
+            self.watch_tree('')
+            self.media = self.scanner.scan(self.src_dir)
+            count = len(self.watches)
+        else:
+            units = set(self.unit(dir_relpath) for dir_relpath in self.dirty)
+            units.discard(None)
+            for (dir_relpath, is_album) in sorted(units):
+                if is_album:
+                    self.update_album(dir_relpath)
+                else:
+                    self.update_dir(dir_relpath)
+            count = len(units)
+        
+        self.dirty.clear()
+        self.full_rescan = False
+        
+        # The rows of the items removed or changed stay in the table of the
+        # media, so it is rebuilt once they outnumber the current ones
+        if len(self.media.table) > 2 * len(self.media) + COMPACT_SLACK:
+            self.media = self.media.compacted()
+        return count
+    
+    def rescan(self):
+        """Scans the whole source again, for when some directories are not
+        watched."""
+        self.media = self.scanner.scan(self.src_dir)
+    
+    def unit(self, dir_relpath):
+        """Returns the (relpath, is_album) pair of what must be scanned again
+        after a change in the directory, following the scanner rules, or None
+        if the directory is ignored."""
+        parts = dir_relpath.split('/') if dir_relpath else []
+        for level in range(len(parts) + 1):
+            relpath = '/'.join(parts[:level])
+            if relpath in self.scanner.ignore:
+                return None
+            if level < 2:
+                is_album = self.scanner.is_album(relpath)
+            else:
+                is_album = not self.scanner.is_not_album(relpath)
+            if is_album:
+                return (relpath, True)
+        return (dir_relpath, False)
+    
+    def update_album(self, album_relpath):
+        # An album is a single item
+        self.media.pop(album_relpath, None)
+        self.add_items(self.scanner.scan_dir(self.src_dir, album_relpath, relpath_level(album_relpath)))
+    
+    def update_dir(self, dir_relpath):
+        """Reads the listing of a directory holding items again."""
+        full_path = os.path.join(self.src_dir, dir_relpath)
+        try:
+            listing = rms.scanner.read_dir(full_path)
+        except OSError:
+            # Removed: its parent takes care of its items
+            return
+        
+        # Removes the items directly in the directory that are gone, and the
+        # ones in subdirectories that are gone. This goes through every item,
+        # but only reads the directory itself.
+        subdirs = set(listing.dirs)
+        present = set()
+        for relpath in self.media.keys():
+            if relpath == dir_relpath or not is_under(relpath, dir_relpath):
+                continue
+            name = relpath[len(dir_relpath) + 1:] if dir_relpath else relpath
+            if '/' in name:
+                subdir = name.split('/', 1)[0]
+                if subdir in subdirs:
+                    present.add(subdir)
+                else:
+                    del self.media[relpath]
+            elif name not in listing.files:
+                del self.media[relpath]
+        
+        level = relpath_level(dir_relpath)
+        for (name, size) in listing.files.iteritems():
+            self.add_items(self.scanner.scan_file(self.src_dir, os.path.join(dir_relpath, name), size))
+        # Only the new subdirectories are scanned. Changes inside the others
+        # have their own events.
+        for name in subdirs - present:
+            self.add_items(self.scanner.scan_dir(self.src_dir, os.path.join(dir_relpath, name), level + 1))
+    
+    def add_items(self, items):
+        for item in items:
+            self.media[item.relpath] = item
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""Benchmarks the phases of rmsync.py on a synthetic media library.
+
+A source tree of artists, albums and loose files is generated in WORKDIR
+(use a tmpfs mount to take the disk out of the measurements), and a
+destination is filled with part of it. Each phase is then run in isolation,
+followed by complete runs of rmsync.py. For every phase the wall time,
+the number of filesystem calls and the peak memory are printed.
+"""
+import json
+import os
+import os.path
+import random
+import shutil
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+
+import rms.files
+import rms.progress
+import rms.scanner
+import rms.stats
+import rms.syscalls
+import rms.text
+import rmsync
+
+
+COUNTS_ENV = 'RMSBENCH_COUNTS'
+
+
+def parse_args():
+    parser = OptionParser(usage="Usage: %prog [options] WORKDIR")
+    parser.add_option("--artists", type="int", default=200,
+                      help="Number of artist directories. Default: %default.")
+    parser.add_option("--albums", type="int", default=3,
+                      help="Average number of albums per artist. Default: %default.")
+    parser.add_option("--tracks", type="int", default=10,
+                      help="Average number of tracks per album. Default: %default.")
+    parser.add_option("--singles", type="int", default=5,
+                      help="Average number of loose files per artist. Default: %default.")
+    parser.add_option("--file-size", dest="file_size", default="32k",
+                      help="Average file size. Default: %default.")
+    parser.add_option("--dst-fraction", dest="dst_fraction", type="float", default=0.3,
+                      help="Fraction of the artists initially in the destination. Default: %default.")
+    parser.add_option("--select-fraction", dest="select_fraction", type="float", default=0.3,
+                      help="Fraction of the source size to be selected. Default: %default.")
+    parser.add_option("--seed", type="int", default=0,
+                      help="Seed for the generated library and the selection. Default: %default.")
+    parser.add_option("--copy-order", dest="copy_order", default="path",
+                      help="Order of the copies in the copy phase. Default: %default.")
+    parser.add_option("--reuse", action="store_true", default=False,
+                      help="Reuse the source tree already generated in WORKDIR.")
+    parser.add_option("--json", dest="json_file", default=None, metavar="FILE",
+                      help="Also write the results to FILE as JSON.")
+    parser.add_option("--rmsync-args", dest="rmsync_args", default="",
+                      help="Extra arguments for the complete runs of rmsync.py.")
+    
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("WORKDIR not specified")
+    options.workdir = args[0]
+    options.file_size = int(rms.text.parse_bytesize(options.file_size))
+    return options
+
+
+def generate_library(root, options):
+    rng = random.Random(options.seed)
+    block = ''.join(chr(rng.randrange(256)) for _ in range(64 * 1024))
+    
+    def write_file(path):
+        size = rng.randint(options.file_size // 2, options.file_size * 3 // 2)
+        with open(path, 'wb') as f:
+            while size > 0:
+                f.write(block[:size])
+                size -= len(block)
+    
+    for artist in range(options.artists):
+        artist_dir = os.path.join(root, 'Artist %05d' % artist)
+        os.makedirs(artist_dir)
+        for single in range(rng.randint(0, 2 * options.singles)):
+            write_file(os.path.join(artist_dir, 'Single %03d.mp3' % single))
+        for album in range(rng.randint(0, 2 * options.albums)):
+            album_dir = os.path.join(artist_dir, 'Album %03d' % album)
+            os.makedirs(album_dir)
+            for track in range(rng.randint(1, 2 * options.tracks)):
+                write_file(os.path.join(album_dir, 'Track %03d.mp3' % track))
+            write_file(os.path.join(album_dir, 'folder.jpg'))
+
+
+def populate_destination(src_dir, dst_dir, options):
+    """Copies part of the source artists to the destination."""
+    if os.path.exists(dst_dir):
+        shutil.rmtree(dst_dir)
+    os.makedirs(dst_dir)
+    
+    rng = random.Random(options.seed + 1)
+    for artist in sorted(os.listdir(src_dir)):
+        if rng.random() >= options.dst_fraction:
+            continue
+        for (dir_fullpath, _, files) in os.walk(os.path.join(src_dir, artist)):
+            dst_dir_fullpath = os.path.join(dst_dir, os.path.relpath(dir_fullpath, src_dir))
+            os.makedirs(dst_dir_fullpath)
+            for file in files:
+                shutil.copyfile(os.path.join(dir_fullpath, file), os.path.join(dst_dir_fullpath, file))
+
+
+def print_phase(row):
+    """Prints the measurements of a phase, as recorded in rms.stats.phases."""
+    if row['peak_rss'] is not None:
+        rss = rms.text.format_bytesize(row['peak_rss'])
+    else:
+        rss = '?'
+    print >>sys.stderr, '%-18s %9.3fs %9s items %10d fs calls %12s peak RSS' % (
+        row['phase'], row['wall'], row['items'] if row['items'] is not None else '-', row['fs_calls'], rss)
+
+
+def measure(phase, function, count_items=len):
+    """Runs function() with its output discarded, as a phase measured by
+    rms.stats. Returns what function() returned."""
+    stdout = sys.stdout
+    # Opened before the phase, so that it does not count its own open()
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            with rms.stats.Phase(phase) as measured:
+                result = function()
+                if count_items:
+                    measured.set(items=count_items(result))
+        finally:
+            sys.stdout = stdout
+    print_phase(rms.stats.phases[-1])
+    return result
+
+
+def run_rmsync(phase, args):
+    """Runs rmsync.py in a child process, so that its peak memory is its own."""
+    counts_file = os.path.join(os.path.dirname(args[-1]), 'counts.json')
+    env = dict(os.environ)
+    env[COUNTS_ENV] = counts_file
+    
+    command = [sys.executable, os.path.abspath(__file__), '--child'] + args
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        process = subprocess.Popen(command, stdout=devnull, env=env)
+        (_, status, rusage) = os.wait4(process.pid, 0)
+    wall = time.time() - start
+    if status != 0:
+        sys.exit('%s failed with status %d' % (' '.join(command), status))
+    
+    with open(counts_file) as f:
+        counts = json.load(f)
+    os.remove(counts_file)
+    rms.stats.phases.append({
+        'phase': phase,
+        'wall': wall,
+        'items': None,
+        'bytes': None,
+        'fs_calls': sum(counts.itervalues()),
+        'fs_calls_by_function': counts,
+        'peak_rss': rms.stats.maxrss_bytes(rusage.ru_maxrss),
+        'completed': True,
+    })
+    print_phase(rms.stats.phases[-1])
+
+
+def run_child(args):
+    """Runs rmsync.py with its filesystem calls counted."""
+    rms.syscalls.install()
+    sys.argv = ['rmsync.py'] + args
+    try:
+        rmsync.main()
+    finally:
+        rms.syscalls.uninstall()
+        with open(os.environ[COUNTS_ENV], 'w') as f:
+            json.dump(rms.syscalls.snapshot(), f)
+
+
+def main():
+    if sys.argv[1:2] == ['--child']:
+        run_child(sys.argv[2:])
+        return
+    
+    options = parse_args()
+    src_dir = os.path.join(options.workdir, 'src')
+    dst_dir = os.path.join(options.workdir, 'dst')
+    rms.syscalls.install()
+    
+    if not options.reuse:
+        if os.path.exists(src_dir):
+            shutil.rmtree(src_dir)
+        measure('generate', lambda: generate_library(src_dir, options), None)
+    measure('populate dst', lambda: populate_destination(src_dir, dst_dir, options), None)
+    
+    scanner = rms.scanner.Scanner([], [], [])
+    src = measure('scan src', lambda: scanner.scan(src_dir))
+    dst = measure('scan dst', lambda: scanner.scan(dst_dir))
+    (src_size, dst_size) = (src.size, dst.size)
+    dst_only = measure('partition', lambda: dst.partition(src))
+    
+    rng = random.Random(options.seed)
+    measure('keep', lambda: rmsync.process_kept_media(src, dst, len(dst) // 2, rng))
+    
+    target = int(dst.size + src_size * options.select_fraction)
+    for strategy in ('random', 'fill'):
+        # Each strategy starts from the same source items
+        candidates = src.copy()
+        selected = measure('select ' + strategy,
+                           lambda: rmsync.select_media(candidates, target, random.Random(options.seed), strategy))
+    dst_delete = dst.partition(selected)
+    src_sel_copy = selected.partition(dst)
+    
+    progress = rms.progress.Progress(dst_delete.size + src_sel_copy.size)
+    measure('delete', lambda: rmsync.delete_media(dst_delete, dst_dir, progress), None)
+    copy_pool = rms.files.CopyPool(src_dir, dst_dir, 1, 0)
+    measure('copy ' + options.copy_order,
+            lambda: rmsync.copy_media(src_sel_copy, src_dir, dst_dir, copy_pool, progress, options.copy_order), None)
+    copy_pool.close()
+    
+    rms.syscalls.uninstall()
+    
+    extra_args = options.rmsync_args.split()
+    for (phase, args) in (('rmsync dry-run', ['--dry-run']),
+                          ('rmsync', []),
+                          ('rmsync mixed-mode', ['--mixed-mode'])):
+        populate_destination(src_dir, dst_dir, options)
+        free = rms.files.get_device_data(dst_dir).free
+        free_target = free + dst_size - int(src_size * options.select_fraction)
+        run_rmsync(phase, args + extra_args + ['--seed', str(options.seed),
+                   '--free', '%db' % max(free_target, 0), src_dir, dst_dir])
+    
+    if options.json_file is not None:
+        with open(options.json_file, 'w') as f:
+            json.dump({'options': dict(vars(options)), 'results': rms.stats.phases}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,198 @@
 #!/usr/bin/env python
+import bisect
+import copy
+import itertools
+import math
+import os.path
 import random
+import sys
+import threading
+import time
 
 from rms.media import Media
 import rms.debug
+import rms.fastcopy
 import rms.files
+import rms.history
+import rms.identity
+import rms.index
+import rms.journal
+import rms.locality
 import rms.options
+import rms.progress
 import rms.scanner
+import rms.sizeindex
+import rms.stats
 import rms.text
+import rms.verify
+import rms.watch
 
 
 #rms.debug.ENABLED = True
 
+# Seconds between checks for the destination in watch mode
+WATCH_POLL_TIME = 1
+
+
+def scan_concurrently(scanner, src_dir, dst_dirs):
+    """Scans each destination in another thread while the source is scanned.
+    Returns the (src, dsts) pair, dsts being a list of Media objects in the
+    order of dst_dirs."""
+    results = [None] * len(dst_dirs)
+    errors = []
+    def scan_dst(i):
+        try:
+            results[i] = scanner.scan(dst_dirs[i])
+        except:
+            errors.append(sys.exc_info())
+    
+    threads = [threading.Thread(target=scan_dst, args=(i,)) for i in range(len(dst_dirs))]
+    for thread in threads:
+        thread.start()
+    try:
+        src = scanner.scan(src_dir)
+    finally:
+        for thread in threads:
+            thread.join()
+    
+    if errors:
+        (type, value, traceback) = errors[0]
+        raise type, value, traceback
+    
+    return (src, results)
+
+
+def destination_options(options):
+    """Returns the options of each destination: options itself, followed by
+    a copy of it for each --also-dest, with its own directory and free, keep
+    and copy jobs settings."""
+    destinations = [options]
+    for settings in options.also_dest:
+        dst_options = copy.copy(options)
+        vars(dst_options).update(settings)
+        destinations.append(dst_options)
+    return destinations
+
+
+class DestinationOutput(object):
+    """Replaces sys.stdout while several destinations are written at the same
+    time. Each line printed by the thread writing a destination is prefixed
+    with the destination directory."""
+    
+    def __init__(self, stream):
+        self.stream = stream
+        self.prefixes = {}
+        self.buffers = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+    
+    # The print statement keeps its state in the softspace attribute of the
+    # file, which must then not be shared by the threads.
+    @property
+    def softspace(self):
+        return getattr(self.local, 'softspace', 0)
+    
+    @softspace.setter
+    def softspace(self, value):
+        self.local.softspace = value
+    
+    def register(self, prefix):
+        """Prefixes the lines printed by the calling thread."""
+        self.prefixes[threading.current_thread().ident] = prefix
+    
+    def write(self, s):
+        ident = threading.current_thread().ident
+        prefix = self.prefixes.get(ident)
+        if prefix is None:
+            with self.lock:
+                self.stream.write(s)
+            return
+        
+        lines = (self.buffers.pop(ident, '') + s).split('\n')
+        if lines[-1]:
+            self.buffers[ident] = lines[-1]
+        with self.lock:
+            for line in lines[:-1]:
+                self.stream.write('[%s] %s\n' % (prefix, line))
+    
+    def flush(self):
+        with self.lock:
+            self.stream.flush()
+
+
+def apply_concurrently(applies):
+    """Calls each (dst_dir, apply) function in its own thread, as each
+    destination is usually a separate device."""
+    output = DestinationOutput(sys.stdout)
+    errors = []
+    def run(dst_dir, apply):
+        output.register(dst_dir)
+        try:
+            apply()
+        except:
+            errors.append(sys.exc_info())
+    
+    threads = [threading.Thread(target=run, args=(dst_dir, apply)) for (dst_dir, apply) in applies]
+    sys.stdout = output
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.stdout = output.stream
+    
+    if errors:
+        (type, value, traceback) = errors[0]
+        raise type, value, traceback
+
+
+def process_renamed_media(dst_only, src, dst, src_dir, dst_dir):
+    """Renames the items in dst_only that have the same contents as an item in
+    src that is not in dst, and moves them to dst under their new path.
+    Returns a dict mapping each new path to its size."""
+    sizes = set((item.type, item.size) for item in dst_only.itervalues())
+    candidates = {}
+    for (path, item) in src.iteritems():
+        if path not in dst and (item.type, item.size) in sizes:
+            candidates.setdefault((item.type, item.size), []).append(item)
+    
+    src_identities = rms.identity.IdentityCache(src_dir)
+    dst_identities = rms.identity.IdentityCache(dst_dir)
+    renamed = {}
+    for old_path in dst_only.sorted():
+        item = dst_only[old_path]
+        bucket = candidates.get((item.type, item.size))
+        if not bucket:
+            continue
+        
+        identity = dst_identities.get(item)
+        for (i, src_item) in enumerate(bucket):
+            if src_identities.get(src_item) == identity:
+                del bucket[i]
+                break
+        else:
+            continue
+        
+        print 'Renaming in the destination: %s -> %s' % (old_path, src_item.relpath)
+        rms.files.rename(dst_dir, old_path, src_item.relpath)
+        del dst_only[old_path]
+        dst[src_item.relpath] = src_item
+        renamed[src_item.relpath] = src_item.size
+    
+    if renamed:
+        print "\tTotal: %d items, %s" % (len(renamed), rms.text.format_bytesize(sum(renamed.itervalues())))
+        print
+    
+    return renamed
+
 
 def process_media_in_dst_only(dst_only, dst_dir, must_delete):
     if dst_only:
         if must_delete:
             print 'Deleting the following items in the destination directory that are not in the source directory:'
-            def f(path):
-                rms.files.delete(dst_dir, path)
+            deletions = rms.files.DeletionBatch(dst_dir)
+            f = deletions.delete
         else:
             print 'The following items in the destination directory will be ignored because they are not in the source directory:'
             def f(path):
@@ -26,115 +201,509 @@ def process_media_in_dst_only(dst_only, dst_dir, must_delete):
         for path in dst_only.sorted():
             print "\t", path
             f(path)
+        if must_delete:
+            deletions.prune()
         print "\tTotal: %s" % rms.text.format_bytesize(dst_only.size)
         
         print
 
 
-def process_kept_media(src, dst, keep_count):
-    src_kept = Media()
-    dst_kept = Media()
+def process_kept_media(src, dst, keep_count, rng=random):
+    src_kept = src.sibling()
+    dst_kept = dst.sibling()
     
-    while len(dst_kept) < keep_count and len(dst) > 0:
-        chosen = random.choice(dst.keys())
+    keep_count = min(int(math.ceil(keep_count)), len(dst))
+    for chosen in rng.sample(sorted(dst), keep_count):
         src.move(chosen, src_kept)
         dst.move(chosen, dst_kept)
     
     return dst_kept
 
 
-def select_media(src, src_selected_size_target):
-    src_selected = Media()
-    src_not_selected = Media()
+def select_media(src, src_selected_size_target, rng=random, strategy='random', weight=None):
+    """weight: if given, a function of an item relpath, so that items are
+    chosen with a probability proportional to it."""
+    src_selected = src.sibling()
+    src_not_selected = src.sibling()
     
-    while len(src) > 0:
-        chosen = random.choice(src.keys())
-        
+    # Visiting the items in a random permutation is equivalent to repeatedly
+    # choosing a random item among the remaining ones.
+    candidates = sorted(src)
+    if weight is None:
+        rng.shuffle(candidates)
+    else:
+        candidates = rms.history.weighted_shuffle(candidates, weight, rng)
+    for chosen in candidates:
         if src_selected.size + src[chosen].size <= src_selected_size_target:
             src.move(chosen, src_selected)
         else:
             src.move(chosen, src_not_selected)
     
+    if strategy == 'fill':
+        fill_selection(src_selected, src_not_selected, src_selected_size_target, rng)
+    else:
+        assert strategy == 'random'
+    
     return src_selected
 
 
-def delete_media(dst_delete, dst_dir):
+def fill_selection(src_selected, src_not_selected, src_selected_size_target, rng=random):
+    """Best-fit pass over a random selection: each selected item, in random
+    order, is swapped with the largest not selected item that still fits in
+    the remaining space, if that one is larger.
+    
+    Every not selected item is already larger than the remaining space, so
+    swapping is the only way to get closer to the target.
+    """
+    candidates = rms.sizeindex.SizeIndex((item.size, path) for (path, item) in src_not_selected.iteritems())
+    
+    selected = sorted(src_selected)
+    rng.shuffle(selected)
+    for path in selected:
+        remaining = src_selected_size_target - src_selected.size
+        if remaining <= 0 or not candidates:
+            break
+        
+        size = src_selected[path].size
+        candidate = candidates.largest_at_most(size + remaining)
+        if candidate is None or candidate[0] <= size:
+            continue
+        
+        (_, other_path) = candidate
+        candidates.remove(candidate)
+        src_selected.move(path, src_not_selected)
+        src_not_selected.move(other_path, src_selected)
+        candidates.add((size, path))
+
+
+def report_progress(progress):
+    print 'Progress %s' % progress.status()
+
+
+def delete_media(dst_delete, dst_dir, progress, journal=None):
     if dst_delete:
         print "Deleting %s" % rms.text.format_bytesize(dst_delete.size)
+        deletions = rms.files.DeletionBatch(dst_dir)
         for item in dst_delete.sorted():
-            print 'Deleting: %s' % item
-            rms.files.delete(dst_dir, item)
+            print 'Deleting %s: %s' % (progress.status(), item)
+            deletions.delete(item)
+            if journal is not None:
+                journal.deleted(item)
+            progress.advance(dst_delete[item].size)
+        deletions.prune()
         print
 
 
-def copy_media(src_sel_copy, src_dir, dst_dir):
+def copy_media(src_sel_copy, src_dir, dst_dir, copy_pool, progress, order='path'):
     if src_sel_copy:
         print "Copying %s" % rms.text.format_bytesize(src_sel_copy.size)
-        for num, path in enumerate(src_sel_copy.sorted(), 1):
-            print 'Copying (%d/%d): %s' % (num, len(src_sel_copy), path)
-            rms.files.copy(src_dir, dst_dir, path)
+        for num, path in enumerate(rms.locality.sorted_paths(src_dir, src_sel_copy, order), 1):
+            print 'Copying (%d/%d) %s: %s' % (num, len(src_sel_copy), progress.status(), path)
+            copy_pool.copy(path, src_sel_copy[path].size, progress)
+        copy_pool.wait()
         print
 
 
-def mixed_mode(src_sel_copy, dst_delete, src_dir, dst_dir, device_free_target):
+def mixed_mode(src_sel_copy, dst_delete, src_dir, dst_dir, device_free_target, copy_pool, progress, journal=None, order=None):
     total_items = len(src_sel_copy) + len(dst_delete)
     i = 0
+    free_space = rms.files.FreeSpace(dst_dir)
+    deletion_batch = rms.files.DeletionBatch(dst_dir)
+    
+    # Items to delete, sorted by size, so that each deletion frees just the
+    # space needed by the next copy when possible.
+    deletions = sorted((item.size, path) for (path, item) in dst_delete.iteritems())
+    deletion_sizes = [size for (size, _) in deletions]
     
-    for path in src_sel_copy:
+    if order is None:
+        paths = src_sel_copy.keys()
+    else:
+        paths = rms.locality.sorted_paths(src_dir, src_sel_copy, order)
+    
+    for path in paths:
         item = src_sel_copy[path]
         
-        while len(dst_delete) > 0 and rms.files.get_device_data(dst_dir).free + item.size < device_free_target:
-            path_delete, _ = dst_delete.popitem()
-            i += 1
-            print 'Deleting (%d/%d): %s' % (i, total_items, path_delete)
-            rms.files.delete(dst_dir, path_delete)
+        if deletions and free_space.free - item.size < device_free_target:
+            # Items being copied must be finished before deleting, both for the
+            # free space to be accurate and for a deletion not to remove a
+            # directory that a copy is about to use.
+            copy_pool.wait()
+            free_space.reconcile()
+            
+            while deletions and free_space.free - item.size < device_free_target:
+                missing = device_free_target - (free_space.free - item.size)
+                # The smallest item that frees enough space, or else the largest one
+                j = min(bisect.bisect_left(deletion_sizes, missing), len(deletions) - 1)
+                (_, path_delete) = deletions.pop(j)
+                deletion_sizes.pop(j)
+                item_delete = dst_delete.pop(path_delete)
+                
+                i += 1
+                print 'Deleting (%d/%d) %s: %s' % (i, total_items, progress.status(), path_delete)
+                deletion_batch.delete(path_delete)
+                if journal is not None:
+                    journal.deleted(path_delete)
+                free_space.deleted(item_delete.size)
+                progress.advance(item_delete.size)
+        elif free_space.reconcile_due():
+            free_space.reconcile(copy_pool.pending_size)
         
         i += 1
-        print 'Copying  (%d/%d): %s' % (i, total_items, path)
-        rms.files.copy(src_dir, dst_dir, path)
+        print 'Copying  (%d/%d) %s: %s' % (i, total_items, progress.status(), path)
+        copy_pool.copy(path, item.size, progress)
+        free_space.copied(item.size)
+    
+    copy_pool.wait()
     
     # Delete remaining items
     for path_delete in dst_delete:
         i += 1
-        print 'Deleting (%d/%d): %s' % (i, total_items, path_delete)
-        rms.files.delete(dst_dir, path_delete)
+        print 'Deleting (%d/%d) %s: %s' % (i, total_items, progress.status(), path_delete)
+        deletion_batch.delete(path_delete)
+        if journal is not None:
+            journal.deleted(path_delete)
+        progress.advance(dst_delete[path_delete].size)
     
+    # No copy is running anymore that could need an empty directory
+    deletion_batch.prune()
     print
     
 
-def main():
-    options = rms.options.get_options()
-    if rms.debug.ENABLED:
-        rms.debug.log('Resulting options:')
-        rms.debug.log(src_dir=options.src_dir)
-        rms.debug.log(dst_dir=options.dst_dir)
-        rms.debug.log(keep=options.keep, keep_is_percent=options.keep_is_percent)
-        rms.debug.log(free=options.free, free_type=options.free_type)
-        rms.debug.log(ignore=options.ignore)
-        rms.debug.log(forced_albums=options.forced_albums)
-        rms.debug.log(not_albums=options.not_albums)
-        rms.debug.log(dry_run=options.dry_run)
-        rms.debug.log(mixed_mode=options.mixed_mode)
-        rms.debug.log(delete_in_dst_only=options.delete_in_dst_only)
-        rms.debug.log()
+def refresh_albums(albums, src_dir, dst_dir, manifest=None):
+    """Copies the files added or changed in the source into the albums that
+    are already in the destination, and deletes the files removed from the
+    source. If a manifest is given, the copies are verified as the others."""
+    print 'Refreshing albums in the destination:'
+    refreshed = 0
+    copied_size = 0
+    for album_relpath in albums.sorted():
+        if not os.path.isdir(os.path.join(src_dir, album_relpath)):
+            continue
+        
+        delta = rms.files.album_delta(src_dir, dst_dir, album_relpath)
+        if not delta.copy and not delta.delete:
+            continue
+        
+        print "\t%s: %d files to copy (%s), %d files to delete" % (
+            album_relpath, len(delta.copy), rms.text.format_bytesize(delta.copy_size), len(delta.delete))
+        rms.files.apply_album_delta(src_dir, dst_dir, album_relpath, delta, manifest)
+        refreshed += 1
+        copied_size += delta.copy_size
+    print "\tTotal: %d of %d albums refreshed, %s copied" % (refreshed, len(albums), rms.text.format_bytesize(copied_size))
     
-    scanner = rms.scanner.Scanner(options.ignore, options.forced_albums, options.not_albums)
+    print
+
+
+def apply_plan(src_sel_copy, dst_delete, src_dir, options, device_free_target, dst_media_size, journal, refresh=None):
+    if options.verify:
+        manifest = rms.verify.Manifest(options.dst_dir)
+        # Mixed mode pops the items it deletes
+        deleted = dst_delete.keys()
+    else:
+        manifest = None
     
-    print 'Scanning source: %s' % options.src_dir
-    src = scanner.scan(options.src_dir)
-    print "%d items found in %s" % (len(src), rms.text.format_bytesize(src.size))
+    copy_pool = rms.files.CopyPool(src_dir, options.dst_dir, options.copy_jobs, options.copy_buffer, journal, manifest)
+    # One total for the whole plan, with the deletions counted as the copies
+    copy_size = src_sel_copy.size
+    delete_size = dst_delete.size
+    progress = rms.progress.Progress(copy_size + delete_size, report=report_progress)
+    try:
+        if options.mixed_mode:
+            with rms.stats.phase('mixed mode') as phase:
+                phase.set(items=len(src_sel_copy) + len(dst_delete), size=src_sel_copy.size + dst_delete.size)
+                mixed_mode(src_sel_copy, dst_delete, src_dir, options.dst_dir, device_free_target, copy_pool, progress, journal, options.copy_order)
+        else:
+            with rms.stats.phase('delete') as phase:
+                phase.set(items=len(dst_delete), size=dst_delete.size)
+                delete_media(dst_delete, options.dst_dir, progress, journal)
+            with rms.stats.phase('copy') as phase:
+                phase.set(items=len(src_sel_copy), size=src_sel_copy.size)
+                copy_media(src_sel_copy, src_dir, options.dst_dir, copy_pool, progress, options.copy_order or 'path')
+        copy_pool.close()
+        if copy_size or delete_size:
+            print "Copied %s and deleted %s: %s" % (rms.text.format_bytesize(copy_size), rms.text.format_bytesize(delete_size), progress.summary())
+            print
+        
+        if manifest is not None:
+            manifest.forget(deleted)
+        
+        if journal is not None:
+            journal.finish()
+        
+        if refresh is not None:
+            with rms.stats.phase('refresh albums') as phase:
+                phase.set(items=len(refresh), size=refresh.size)
+                refresh_albums(refresh, src_dir, options.dst_dir, manifest)
+    finally:
+        # Also when interrupted, for the files verified so far
+        if manifest is not None and not options.dry_run:
+            manifest.save()
     
+    device_data = rms.files.get_device_data(options.dst_dir)
+    print "Total size of the destination device: %s" % rms.text.format_bytesize(device_data.total)
+    print "Media in the destination device: %s (%s)" % (rms.text.format_bytesize(dst_media_size), rms.text.format_percent(dst_media_size, device_data.total))
+    print "Free space in the destination device: %s (%s)" % (rms.text.format_bytesize(device_data.free), rms.text.format_percent(device_data.free, device_data.total))
+
+
+def get_item_size(base_path, item, block_size=None):
+    """Returns the size of the item in base_path, counted as the scanner
+    does."""
+    if item.type == 'ALBUM':
+        return rms.scanner.Scanner([], [], [], block_size=block_size).album_size(base_path, item.relpath)
+    else:
+        return rms.scanner.allocated_size(os.path.getsize(os.path.join(base_path, item.relpath)), block_size)
+
+
+def remove_unfinished_copies(journal, dst_dir):
+    """Removes the copies of the journal plan that were started but not
+    finished, or whose size does not match the plan. Returns a Media with
+    the copies that remain to be done."""
+    src_sel_copy = Media()
+    redone = 0
+    for (type, relpath, size) in journal.plan.copy:
+        item = Media.Item(type=type, relpath=relpath, size=size)
+        exists = os.path.lexists(os.path.join(dst_dir, relpath))
+        if relpath in journal.copied_paths and exists and get_item_size(dst_dir, item, journal.plan.block_size) == size:
+            continue
+        
+        if exists:
+            print 'Removing partially copied item: %s' % relpath
+            rms.files.delete(dst_dir, relpath)
+            redone += 1
+        src_sel_copy[relpath] = item
+    
+    if redone:
+        print
+    return src_sel_copy
+
+
+def resume(options):
+    journal = rms.journal.Journal.load(options.dst_dir)
+    if journal is None:
+        sys.exit("No interrupted sync found in %s" % options.dst_dir)
+    
+    plan = journal.plan
+    src_dir = options.src_dir if options.src_dir is not None else plan.src_dir
+    options.mixed_mode = plan.mixed_mode
+    
+    print 'Resuming the interrupted sync from %s to %s' % (src_dir, options.dst_dir)
     print
     
-    print 'Scanning destination: %s' % options.dst_dir
-    dst = scanner.scan(options.dst_dir)
-    print "%d items found in %s" % (len(dst), rms.text.format_bytesize(dst.size))
+    dst_delete = Media()
+    for (type, relpath, size) in plan.delete:
+        if relpath not in journal.deleted_paths and os.path.lexists(os.path.join(options.dst_dir, relpath)):
+            dst_delete[relpath] = Media.Item(type=type, relpath=relpath, size=size)
     
+    if options.dry_run:
+        src_sel_copy = Media(
+            (relpath, Media.Item(type=type, relpath=relpath, size=size))
+            for (type, relpath, size) in plan.copy
+            if relpath not in journal.copied_paths
+        )
+        journal.close()
+        journal = None
+    else:
+        src_sel_copy = remove_unfinished_copies(journal, options.dst_dir)
+    
+    print "Remaining: %d items to delete (%s) and %d items to copy (%s)" % (
+        len(dst_delete), rms.text.format_bytesize(dst_delete.size),
+        len(src_sel_copy), rms.text.format_bytesize(src_sel_copy.size))
     print
     
+    apply_plan(src_sel_copy, dst_delete, src_dir, options, plan.device_free_target, plan.dst_media_size, journal)
+
+
+def check_plan(plan, src_dir, dst_dir):
+    """Checks that the items of a plan computed earlier did not change since.
+    Returns the Media to delete and to copy, or exits if the plan is out of
+    date. Items to delete that are already gone are left out."""
+    dst_delete = Media()
+    for (type, relpath, size) in plan.delete:
+        if os.path.lexists(os.path.join(dst_dir, relpath)):
+            dst_delete[relpath] = Media.Item(type=type, relpath=relpath, size=size)
+    
+    src_sel_copy = Media()
+    stale = []
+    for (type, relpath, size) in plan.copy:
+        item = Media.Item(type=type, relpath=relpath, size=size)
+        src_fullpath = os.path.join(src_dir, relpath)
+        if type == 'ALBUM':
+            exists = os.path.isdir(src_fullpath)
+        else:
+            exists = os.path.isfile(src_fullpath)
+        
+        if not exists or get_item_size(src_dir, item, plan.block_size) != size:
+            stale.append('changed in the source: %s' % relpath)
+        elif os.path.lexists(os.path.join(dst_dir, relpath)):
+            stale.append('already in the destination: %s' % relpath)
+        else:
+            src_sel_copy[relpath] = item
+    
+    if stale:
+        print 'The following items of the plan changed since it was computed:'
+        for line in stale:
+            print "\t", line
+        print
+        sys.exit("The plan is out of date. Compute it again.")
     
+    return (dst_delete, src_sel_copy)
+
+
+def apply_saved_plan(options):
+    plan = rms.journal.read_plan(options.apply_plan)
+    if plan is None:
+        sys.exit("Invalid plan file: %s" % options.apply_plan)
+    
+    src_dir = options.src_dir if options.src_dir is not None else plan.src_dir
+    options.mixed_mode = plan.mixed_mode
+    
+    print 'Applying the plan in %s from %s to %s' % (options.apply_plan, src_dir, options.dst_dir)
+    print
+    
+    if not options.dry_run:
+        discard_interrupted_sync(options.dst_dir)
+    
+    with rms.stats.phase('check plan') as phase:
+        (dst_delete, src_sel_copy) = check_plan(plan, src_dir, options.dst_dir)
+        phase.set(items=len(plan.delete) + len(plan.copy))
+    
+    print "Plan: %d items to delete (%s) and %d items to copy (%s)" % (
+        len(dst_delete), rms.text.format_bytesize(dst_delete.size),
+        len(src_sel_copy), rms.text.format_bytesize(src_sel_copy.size))
+    print
+    
+    if options.dry_run:
+        journal = None
+    else:
+        plan = plan._replace(
+            src_dir=src_dir,
+            delete=[tuple(item) for item in dst_delete.itervalues()],
+            copy=[tuple(item) for item in src_sel_copy.itervalues()],
+        )
+        journal = rms.journal.Journal.create(options.dst_dir, plan)
+    
+    apply_plan(src_sel_copy, dst_delete, src_dir, options, plan.device_free_target, plan.dst_media_size, journal)
+
+
+def discard_interrupted_sync(dst_dir):
+    """Cleans up after an interrupted sync that will not be resumed."""
+    journal = rms.journal.Journal.load(dst_dir)
+    if journal is not None:
+        print 'An interrupted sync was found in the destination. It will be discarded (use --resume to finish it instead).'
+        remove_unfinished_copies(journal, dst_dir)
+        journal.finish()
+        print
+
+
+def sync(options, src=None):
+    """Syncs the destinations from the source. If src is given, it is used
+    instead of scanning the source, and is left unchanged."""
+    destinations = destination_options(options)
+    
+    if not options.dry_run and options.write_plan is None:
+        for dst_options in destinations:
+            discard_interrupted_sync(dst_options.dst_dir)
+    
+    if options.scan_index is not None:
+        scan_index = rms.index.ScanIndex(options.scan_index, rescan=options.rescan)
+    else:
+        scan_index = None
+    
+    dst_dirs = [dst_options.dst_dir for dst_options in destinations]
+    block_size = destinations_block_size(dst_dirs)
+    scanner = rms.scanner.Scanner(options.ignore, options.forced_albums, options.not_albums, scan_index, options.scan_jobs, block_size)
+    
+    if src is None and options.scan_jobs > 1:
+        print 'Scanning source: %s' % options.src_dir
+        for dst_dir in dst_dirs:
+            print 'Scanning destination: %s' % dst_dir
+        with rms.stats.phase('scan') as phase:
+            (src, dsts) = scan_concurrently(scanner, options.src_dir, dst_dirs)
+            phase.set(items=len(src) + sum(len(dst) for dst in dsts), size=src.size + sum(dst.size for dst in dsts))
+        print "%d items found in the source in %s" % (len(src), rms.text.format_bytesize(src.size))
+        for (dst_dir, dst) in zip(dst_dirs, dsts):
+            if len(dsts) == 1:
+                print "%d items found in the destination in %s" % (len(dst), rms.text.format_bytesize(dst.size))
+            else:
+                print "%d items found in %s in %s" % (len(dst), dst_dir, rms.text.format_bytesize(dst.size))
+        
+        print
+    else:
+        if src is None:
+            print 'Scanning source: %s' % options.src_dir
+            with rms.stats.phase('scan src') as phase:
+                src = scanner.scan(options.src_dir)
+                phase.set(items=len(src), size=src.size)
+            print "%d items found in %s" % (len(src), rms.text.format_bytesize(src.size))
+        else:
+            # Planning changes it
+            src = src.copy()
+            print "%d items in the source in %s" % (len(src), rms.text.format_bytesize(src.size))
+        
+        print
+        
+        dsts = []
+        for dst_dir in dst_dirs:
+            print 'Scanning destination: %s' % dst_dir
+            with rms.stats.phase('scan dst') as phase:
+                dst = scanner.scan(dst_dir)
+                phase.set(items=len(dst), size=dst.size)
+            print "%d items found in %s" % (len(dst), rms.text.format_bytesize(dst.size))
+            dsts.append(dst)
+            
+            print
+    
+    scanner.close()
+    
+    if scan_index is not None:
+        scan_index.save()
+        print "%d of %d directories served from the scan index" % (scan_index.hits, scan_index.hits + scan_index.misses)
+        print
+    
+    
+    rng = random.Random(options.seed)
+    
+    if len(destinations) == 1:
+        apply = plan_destination(options, src, dsts[0], block_size, rng)
+        if apply is not None:
+            apply()
+        return
+    
+    devices = set(os.stat(dst_dir).st_dev for dst_dir in dst_dirs)
+    if len(devices) < len(dst_dirs):
+        print 'WARNING: some destinations are in the same device. Their free space targets do not take each other into account.'
+        print
+    
+    # Each destination is planned in turn, selecting from its own copy of the
+    # source items, and then all of them are written at the same time. Each
+    # one has its own random sequence, seeded from the main one, so that
+    # their selections are independent.
+    applies = []
+    for (dst_options, dst) in zip(destinations, dsts):
+        print '== Destination: %s' % dst_options.dst_dir
+        print
+        dst_rng = random.Random(rng.getrandbits(64))
+        applies.append(plan_destination(dst_options, src.copy(), dst, block_size, dst_rng))
+    
+    apply_concurrently(zip(dst_dirs, applies))
+
+
+def plan_destination(options, src, dst, block_size=None, rng=None):
+    """Selects the media for the destination in options from src, which is
+    changed. The item sizes are the ones for blocks of block_size. The random
+    choices are taken from rng, seeded from options.seed if not given.
+    Returns a function that applies the resulting plan, or None if the plan
+    was written to a file instead."""
     # Finds media in the destination which are not in the source.
-    dst_only = dst.partition(src)
+    with rms.stats.phase('partition') as phase:
+        dst_only = dst.partition(src)
+        phase.set(items=len(dst_only), size=dst_only.size)
+    if options.detect_renames:
+        with rms.stats.phase('renames') as phase:
+            renamed = process_renamed_media(dst_only, src, dst, options.src_dir, options.dst_dir)
+            phase.set(items=len(renamed), size=sum(renamed.itervalues()))
+    else:
+        renamed = {}
     process_media_in_dst_only(dst_only, options.dst_dir, options.delete_in_dst_only)
     
     
@@ -142,6 +711,7 @@ def main():
     print "Total size of the destination device: %s" % rms.text.format_bytesize(device_data.total)
     print "Media currently in the destination device: %s (%s)" % (rms.text.format_bytesize(dst.size), rms.text.format_percent(dst.size, device_data.total))
     print "Current free space in the destination device: %s (%s)" % (rms.text.format_bytesize(device_data.free), rms.text.format_percent(device_data.free, device_data.total))
+    print "Block size of the destination device: %s" % rms.text.format_bytesize(device_data.block_size)
     print
     
     
@@ -150,7 +720,33 @@ def main():
     else:
         keep_count = options.keep
     
-    dst_kept = process_kept_media(src, dst, keep_count)
+    if options.history:
+        history = rms.history.History(options.dst_dir)
+        now = time.time()
+        weight = lambda path: history.weight(path, now)
+    else:
+        history = None
+        weight = None
+    
+    if options.refresh_albums:
+        src_sizes = dict((path, src[path].size) for path in dst if path in src)
+    
+    if rng is None:
+        rng = random.Random(options.seed)
+    with rms.stats.phase('keep') as phase:
+        dst_kept = process_kept_media(src, dst, keep_count, rng)
+        phase.set(items=len(dst_kept), size=dst_kept.size)
+    
+    if options.refresh_albums:
+        # The kept items are out of the selection, so the refresh of the kept
+        # albums that grew in the source must be budgeted here
+        refresh_growth = sum(max(src_sizes.get(item.relpath, 0) - item.size, 0)
+                             for item in dst_kept.itervalues() if item.type == 'ALBUM')
+        if refresh_growth:
+            print "Growth of the kept albums to refresh: %s" % rms.text.format_bytesize(refresh_growth)
+            print
+    else:
+        refresh_growth = 0
     
     
     if options.free_type == 'BYTES':
@@ -162,24 +758,284 @@ def main():
         assert options.free is None
         device_free_target = device_data.free
     
-    src_selected_size_target = dst.size + device_data.free - device_free_target
-    src_selected = select_media(src, src_selected_size_target)
+    src_selected_size_target = dst.size + device_data.free - device_free_target - refresh_growth
+    with rms.stats.phase('select') as phase:
+        src_selected = select_media(src, src_selected_size_target, rng, options.strategy, weight)
+        phase.set(items=len(src_selected), size=src_selected.size)
+    if src_selected_size_target > 0:
+        print "Selected media: %s of a target of %s (%s filled)" % (rms.text.format_bytesize(src_selected.size), rms.text.format_bytesize(src_selected_size_target), rms.text.format_percent(src_selected.size, src_selected_size_target))
+        print
     
     
     dst_delete = dst.partition(src_selected)
     src_sel_copy = src_selected.partition(dst)
+    dst_media_size = dst.size + dst_kept.size + src_sel_copy.size
     
-    if options.mixed_mode:
-        mixed_mode(src_sel_copy, dst_delete, options.src_dir, options.dst_dir, device_free_target)
+    plan = rms.journal.Plan(
+        src_dir=os.path.abspath(options.src_dir),
+        delete=[tuple(item) for item in dst_delete.itervalues()],
+        copy=[tuple(item) for item in src_sel_copy.itervalues()],
+        device_free_target=device_free_target,
+        mixed_mode=options.mixed_mode,
+        dst_media_size=dst_media_size,
+        block_size=block_size,
+    )
+    
+    if options.write_plan is not None:
+        rms.journal.write_plan(options.write_plan, plan)
+        print "Plan written to %s: %d items to delete (%s) and %d items to copy (%s)" % (
+            options.write_plan,
+            len(dst_delete), rms.text.format_bytesize(dst_delete.size),
+            len(src_sel_copy), rms.text.format_bytesize(src_sel_copy.size))
+        return None
+    
+    if options.dry_run:
+        journal = None
     else:
-        delete_media(dst_delete, options.dst_dir)
-        copy_media(src_sel_copy, options.src_dir, options.dst_dir)
+        journal = rms.journal.Journal.create(options.dst_dir, plan)
     
-    device_data = rms.files.get_device_data(options.dst_dir)
-    dst_media_size = dst.size + dst_kept.size + src_sel_copy.size
-    print "Total size of the destination device: %s" % rms.text.format_bytesize(device_data.total)
-    print "Media in the destination device: %s (%s)" % (rms.text.format_bytesize(dst_media_size), rms.text.format_percent(dst_media_size, device_data.total))
-    print "Free space in the destination device: %s (%s)" % (rms.text.format_bytesize(device_data.free), rms.text.format_percent(device_data.free, device_data.total))
+    if options.refresh_albums:
+        # The albums that stay in the destination
+        refresh = dst.sibling()
+        for albums in (dst, dst_kept):
+            for item in albums.itervalues():
+                if item.type == 'ALBUM':
+                    refresh[item.relpath] = item
+    else:
+        refresh = None
+    
+    def apply():
+        # Mixed mode pops the items it deletes
+        deleted = set(dst_delete)
+        apply_plan(src_sel_copy, dst_delete, options.src_dir, options, device_free_target, dst_media_size, journal, refresh)
+        
+        if history is not None and not options.dry_run:
+            history.placed(itertools.chain(dst, dst_kept, src_sel_copy))
+            history.save()
+        
+        if renamed:
+            saved_size = sum(size for (path, size) in renamed.iteritems() if path not in deleted)
+            print "Size not copied again thanks to renaming: %s" % rms.text.format_bytesize(saved_size)
+    
+    return apply
+
+
+
+def check_destination(options):
+    """Reads back the files in the manifest of the destination, the ones
+    checked the longest ago first, and compares them to their hashes."""
+    manifest = rms.verify.Manifest(options.dst_dir)
+    if not manifest.entries:
+        sys.exit('No verified files in the destination. Sync with --verify first.')
+    
+    relpaths = manifest.oldest(options.check_size)
+    total_size = sum(manifest.entries[relpath][0] for relpath in relpaths)
+    print "Checking %d files in %s" % (len(relpaths), rms.text.format_bytesize(total_size))
+    
+    progress = rms.progress.Progress(total_size)
+    corrupt = []
+    changed = 0
+    with rms.stats.phase('check') as phase:
+        phase.set(items=len(relpaths), size=total_size)
+        for relpath in relpaths:
+            print 'Checking %s: %s' % (progress.status(), relpath)
+            size = manifest.entries[relpath][0]
+            result = manifest.check(relpath)
+            if result == 'corrupt':
+                corrupt.append(relpath)
+            elif result == 'changed':
+                changed += 1
+            progress.advance(size)
+    print "Checked %s" % progress.summary()
+    print
+    
+    if not options.dry_run:
+        manifest.save()
+    
+    print "%d files checked, %d changed since verified, %d corrupt" % (len(relpaths), changed, len(corrupt))
+    if corrupt:
+        for relpath in corrupt:
+            print "Corrupt: %s" % relpath
+        sys.exit('Corrupt files found in the destination')
+
+
+def destinations_block_size(dst_dirs):
+    """Returns the largest allocation unit of the devices of the existing
+    destinations, or None if none exists. The items are sized for it, which
+    overestimates them in the destinations with smaller blocks."""
+    block_sizes = []
+    for dst_dir in dst_dirs:
+        try:
+            block_sizes.append(rms.files.get_device_data(dst_dir).block_size)
+        except OSError:
+            pass
+    return max(block_sizes) if block_sizes else None
+
+
+def mount_point(path):
+    """Returns the mount point of the file system that contains path."""
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def destination_device(dst_dir, mount=None):
+    """Returns the (device, reason) pair of the destination directory. The
+    device is None if the destination is not available, and reason then
+    tells why: it does not exist, or it is no longer in the file system
+    mounted at mount, as when a device is unmounted but its mount point is
+    left in place."""
+    try:
+        device = os.stat(dst_dir).st_dev
+    except OSError as e:
+        return (None, e.strerror)
+    if mount is not None and mount_point(dst_dir) != mount:
+        return (None, 'nothing mounted at %s' % mount)
+    return (device, None)
+
+
+def watch(options):
+    """Keeps an index of the source current and syncs each time the
+    destinations appear, or are on a different device than in the last
+    sync."""
+    dst_dirs = [dst_options.dst_dir for dst_options in destination_options(options)]
+    print 'Scanning source: %s' % options.src_dir
+    with rms.stats.phase('scan src') as phase:
+        live_source = rms.watch.LiveSource(options.src_dir, options.ignore, options.forced_albums, options.not_albums,
+                                           destinations_block_size(dst_dirs))
+        phase.set(items=len(live_source.media), size=live_source.media.size)
+    print "%d items found in %s" % (len(live_source.media), rms.text.format_bytesize(live_source.media.size))
+    print
+    
+    # dst_dir -> mount point of its file system when it was first found
+    mounts = {}
+    synced_devices = None
+    waiting_reasons = None
+    warned = False
+    try:
+        while True:
+            if live_source.watch_errors and not warned:
+                (relpath, e) = live_source.watch_errors[0]
+                print 'WARNING: %d source directories cannot be watched (%s: %s). The source will be scanned again before each sync.' % (
+                    len(live_source.watch_errors), os.path.join(options.src_dir, relpath), e.strerror)
+                print
+                warned = True
+            
+            statuses = [destination_device(dst_dir, mounts.get(dst_dir)) for dst_dir in dst_dirs]
+            for (dst_dir, (device, _)) in zip(dst_dirs, statuses):
+                if device is not None and dst_dir not in mounts:
+                    mounts[dst_dir] = mount_point(dst_dir)
+                    print 'Destination %s is in the file system mounted at %s, and will only be synced while it is mounted.' % (
+                        dst_dir, mounts[dst_dir])
+                    print
+            
+            devices = [device for (device, _) in statuses]
+            if None in devices:
+                synced_devices = None
+                reasons = [(dst_dir, reason) for (dst_dir, (device, reason)) in zip(dst_dirs, statuses) if device is None]
+                if reasons != waiting_reasons:
+                    print 'Waiting for the destination:'
+                    for (dst_dir, reason) in reasons:
+                        print "\t%s: %s" % (dst_dir, reason)
+                    print
+                    waiting_reasons = reasons
+            elif devices != synced_devices:
+                waiting_reasons = None
+                print 'Destination available. Syncing.'
+                print
+                block_size = destinations_block_size(dst_dirs)
+                if block_size != live_source.block_size:
+                    print 'Sizing the source for blocks of %s' % rms.text.format_bytesize(block_size)
+                    print
+                    live_source.set_block_size(block_size)
+                if live_source.watch_errors:
+                    print 'Scanning source: %s' % options.src_dir
+                    with rms.stats.phase('scan src') as phase:
+                        live_source.rescan()
+                        phase.set(items=len(live_source.media), size=live_source.media.size)
+                    print
+                try:
+                    sync(options, live_source.media)
+                except EnvironmentError as e:
+                    # Probably disconnected during the sync
+                    print 'Sync failed: %s' % e
+                print
+                synced_devices = devices
+                print 'Done. Waiting for the destination to be connected again.'
+                print
+            
+            updated = live_source.wait(WATCH_POLL_TIME)
+            if updated:
+                print 'Source changed: %d directories updated, %d items in %s' % (
+                    updated, len(live_source.media), rms.text.format_bytesize(live_source.media.size))
+    except KeyboardInterrupt:
+        print
+    finally:
+        live_source.close()
+
+
+def main():
+    options = rms.options.get_options()
+    if rms.debug.ENABLED:
+        rms.debug.log('Resulting options:')
+        rms.debug.log(src_dir=options.src_dir)
+        rms.debug.log(dst_dir=options.dst_dir)
+        rms.debug.log(keep=options.keep, keep_is_percent=options.keep_is_percent)
+        rms.debug.log(free=options.free, free_type=options.free_type)
+        rms.debug.log(ignore=options.ignore)
+        rms.debug.log(forced_albums=options.forced_albums)
+        rms.debug.log(not_albums=options.not_albums)
+        rms.debug.log(dry_run=options.dry_run)
+        rms.debug.log(mixed_mode=options.mixed_mode)
+        rms.debug.log(delete_in_dst_only=options.delete_in_dst_only)
+        rms.debug.log(scan_index=options.scan_index)
+        rms.debug.log(rescan=options.rescan)
+        rms.debug.log(scan_jobs=options.scan_jobs)
+        rms.debug.log(seed=options.seed)
+        rms.debug.log(strategy=options.strategy)
+        rms.debug.log(copy_jobs=options.copy_jobs)
+        rms.debug.log(copy_buffer=options.copy_buffer)
+        rms.debug.log(resume=options.resume)
+        rms.debug.log(detect_renames=options.detect_renames)
+        rms.debug.log(profile=options.profile)
+        rms.debug.log(stats_json=options.stats_json)
+        rms.debug.log(write_plan=options.write_plan)
+        rms.debug.log(apply_plan=options.apply_plan)
+        rms.debug.log(refresh_albums=options.refresh_albums)
+        rms.debug.log(also_dest=options.also_dest)
+        rms.debug.log(copy_order=options.copy_order)
+        rms.debug.log(watch=options.watch)
+        rms.debug.log(history=options.history)
+        rms.debug.log(verify=options.verify)
+        rms.debug.log(check=options.check)
+        rms.debug.log(check_size=options.check_size)
+        rms.debug.log(copy_io=options.copy_io)
+        rms.debug.log()
+    
+    if options.profile or options.stats_json is not None:
+        rms.stats.enable()
+    
+    if options.copy_io == 'stream':
+        rms.fastcopy.enable_streaming()
+    
+    try:
+        if options.resume:
+            resume(options)
+        elif options.apply_plan is not None:
+            apply_saved_plan(options)
+        elif options.check:
+            check_destination(options)
+        elif options.watch:
+            watch(options)
+        else:
+            sync(options)
+    finally:
+        if options.profile:
+            print
+            rms.stats.print_report()
+        if options.stats_json is not None:
+            rms.stats.write_json(options.stats_json)
 
 
 if __name__ == '__main__':